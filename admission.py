@@ -0,0 +1,197 @@
+from collections import OrderedDict
+import math
+import threading
+import time
+
+# Admission control for the endpoints that spike at the top of the hour.
+# Check-ins pass a per-class and a global token bucket before they touch
+# the database. When a bucket is empty the request may wait for its token,
+# up to CHECKIN_MAX_WAIT seconds and with at most CHECKIN_QUEUE_SIZE
+# requests waiting; anything beyond that is shed right away. Logins go
+# through a concurrency limiter around the user lookup and password check,
+# with the same kind of bounded wait.
+#
+# Shed requests raise Shed, which the views turn into a 429 (this class is
+# over its rate) or 503 (the server as a whole is saturated) response with
+# a Retry-After header. A rate of 0 turns a bucket off.
+
+
+class Shed(Exception):
+    def __init__(self, status, retry_after, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+    # Whole seconds for the Retry-After header
+    @property
+    def retry_after_header(self):
+        return str(max(1, int(math.ceil(self.retry_after))))
+
+
+# Tokens may go negative: each request that has to wait reserves the next
+# free token, so waiting requests are served in arrival order at `rate`
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    # Takes a token and returns how long to wait until it is valid
+    def reserve(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self):
+        self.tokens += 1
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class AdmissionControl():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._global = None
+        self._classes = OrderedDict()
+        self._checkins_waiting = 0
+        self._logins = None
+        self._logins_active = 0
+        self._logins_waiting = 0
+        self._counts = dict((name, 0) for name in (
+            'checkin_admitted', 'checkin_queued', 'checkin_shed_class', 'checkin_shed_global',
+            'login_admitted', 'login_queued', 'login_shed'))
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('CHECKIN_CLASS_RATE', 50)
+        app.config.setdefault('CHECKIN_CLASS_BURST', 100)
+        app.config.setdefault('CHECKIN_GLOBAL_RATE', 500)
+        app.config.setdefault('CHECKIN_GLOBAL_BURST', 1000)
+        app.config.setdefault('CHECKIN_MAX_WAIT', 2.0)
+        app.config.setdefault('CHECKIN_QUEUE_SIZE', 200)
+        app.config.setdefault('CHECKIN_BUCKETS', 4096)
+        app.config.setdefault('LOGIN_CONCURRENCY', 8)
+        app.config.setdefault('LOGIN_QUEUE_SIZE', 32)
+        app.config.setdefault('LOGIN_MAX_WAIT', 2.0)
+        self._logins = threading.Condition(self._lock)
+
+    # Returns once the check-in may proceed, possibly after waiting for its
+    # token, or raises Shed
+    def admit_check_in(self, class_id):
+        config = self.app.config
+        max_wait = config['CHECKIN_MAX_WAIT']
+        with self._lock:
+            now = time.monotonic()
+            buckets = []
+            if config['CHECKIN_CLASS_RATE'] > 0:
+                buckets.append(('class', self._class_bucket(class_id, now)))
+            if config['CHECKIN_GLOBAL_RATE'] > 0:
+                if self._global is None:
+                    self._global = TokenBucket(config['CHECKIN_GLOBAL_RATE'], config['CHECKIN_GLOBAL_BURST'])
+                buckets.append(('global', self._global))
+
+            waits = dict((scope, bucket.reserve(now)) for scope, bucket in buckets)
+            wait = max(waits.values()) if waits else 0.0
+            if wait > 0 and (wait > max_wait or self._checkins_waiting >= config['CHECKIN_QUEUE_SIZE']):
+                for scope, bucket in buckets:
+                    bucket.refund()
+                # A full queue or an empty global bucket means the whole
+                # server is saturated, not just this class
+                if self._checkins_waiting >= config['CHECKIN_QUEUE_SIZE'] or \
+                        waits.get('global', 0) >= waits.get('class', 0):
+                    self._counts['checkin_shed_global'] += 1
+                    raise Shed(503, wait, 'Too many check-ins right now')
+                self._counts['checkin_shed_class'] += 1
+                raise Shed(429, wait, 'Too many check-ins for this class right now')
+
+            self._counts['checkin_admitted'] += 1
+            if wait > 0:
+                self._counts['checkin_queued'] += 1
+                self._checkins_waiting += 1
+
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self._checkins_waiting -= 1
+
+    # Context manager holding one of LOGIN_CONCURRENCY login slots
+    def login_slot(self):
+        return _LoginSlot(self)
+
+    def _acquire_login(self):
+        config = self.app.config
+        with self._lock:
+            if self._logins_active < config['LOGIN_CONCURRENCY']:
+                self._logins_active += 1
+                self._counts['login_admitted'] += 1
+                return
+            if self._logins_waiting >= config['LOGIN_QUEUE_SIZE']:
+                self._counts['login_shed'] += 1
+                raise Shed(503, config['LOGIN_MAX_WAIT'], 'Too many logins right now')
+
+            self._logins_waiting += 1
+            deadline = time.monotonic() + config['LOGIN_MAX_WAIT']
+            try:
+                while self._logins_active >= config['LOGIN_CONCURRENCY']:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counts['login_shed'] += 1
+                        raise Shed(503, config['LOGIN_MAX_WAIT'], 'Too many logins right now')
+                    self._logins.wait(remaining)
+            finally:
+                self._logins_waiting -= 1
+            self._logins_active += 1
+            self._counts['login_admitted'] += 1
+            self._counts['login_queued'] += 1
+
+    def _release_login(self):
+        with self._lock:
+            self._logins_active -= 1
+            self._logins.notify()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['checkin_waiting'] = self._checkins_waiting
+            stats['login_active'] = self._logins_active
+            stats['login_waiting'] = self._logins_waiting
+            return stats
+
+    # Buckets of classes that have been idle long enough to be full again
+    # carry no state, so the least recently used ones are dropped first
+    def _class_bucket(self, class_id, now):
+        bucket = self._classes.get(class_id)
+        if bucket is None:
+            bucket = TokenBucket(self.app.config['CHECKIN_CLASS_RATE'], self.app.config['CHECKIN_CLASS_BURST'])
+            self._classes[class_id] = bucket
+            while len(self._classes) > self.app.config['CHECKIN_BUCKETS']:
+                oldest = next(iter(self._classes))
+                if not self._classes[oldest].full(now):
+                    break
+                del self._classes[oldest]
+        self._classes.move_to_end(class_id)
+        return bucket
+
+
+class _LoginSlot():
+    def __init__(self, admission):
+        self.admission = admission
+
+    def __enter__(self):
+        self.admission._acquire_login()
+
+    def __exit__(self, *exc):
+        self.admission._release_login()
+
+
+admission = AdmissionControl()
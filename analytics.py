@@ -0,0 +1,193 @@
+from itertools import groupby
+from models import db, User, Enrollment, Attendance, AttendanceArchive
+from operator import itemgetter
+from reports import session_dates
+import archive
+from sqlalchemy import and_, distinct, func, literal_column, null, select, union_all
+import numpy as np
+
+# Vectorized attendance analytics.
+# A class's attendance is loaded with one query into a boolean matrix of
+# students x session dates, and every statistic is computed with array
+# operations over the whole class at once. department_report() does the
+# same for every class from a single query, streamed in class_id order and
+# summarized one class at a time.
+#
+# Sessions are the ones reports.py counts: every date anyone checked in on,
+# dropped students included, see reports.session_dates(). A class without
+# sessions has no attendance rates, they are None rather than 0.
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+
+class AttendanceMatrix():
+    def __init__(self, class_id, user_ids, names, dates, present):
+        self.class_id = class_id
+        self.user_ids = user_ids
+        self.names = names
+        # datetime64[D], ascending
+        self.dates = dates
+        # bool, one row per student and one column per session
+        self.present = present
+
+    # NaN for every student of a class without sessions
+    def student_rates(self):
+        if not self.dates.size:
+            return np.full(len(self.user_ids), np.nan)
+        return self.present.mean(axis=1)
+
+    def session_rates(self):
+        if not self.user_ids.size:
+            return np.zeros(len(self.dates))
+        return self.present.mean(axis=0)
+
+    # Longest run of consecutive missed sessions per student
+    def longest_absence_streaks(self):
+        students, sessions = self.present.shape
+        padded = np.zeros((students, sessions + 2), dtype=np.int8)
+        padded[:, 1:-1] = ~self.present
+        edges = np.diff(padded, axis=1)
+        # Starts and ends of absence runs come out in the same row-major order
+        rows, starts = np.nonzero(edges == 1)
+        ends = np.nonzero(edges == -1)[1]
+        longest = np.zeros(students, dtype=np.int64)
+        np.maximum.at(longest, rows, ends - starts)
+        return longest
+
+    # Indices of students attending less than threshold (0..1), nobody
+    # before the first session
+    def at_risk(self, threshold):
+        return np.nonzero(self.student_rates() < threshold)[0]
+
+    # Mean session attendance rate per weekday, NaN for weekdays without sessions
+    def weekday_rates(self):
+        # 1970-01-01 was a Thursday, shift so Monday is 0
+        weekdays = (self.dates.astype(np.int64) + 3) % 7
+        return _grouped_mean(weekdays, self.session_rates(), 7)
+
+    # Mean session attendance rate per week of term, counted from the first session
+    def weekly_rates(self):
+        if not self.dates.size:
+            return np.zeros(0)
+        weeks = (self.dates - self.dates[0]).astype(np.int64) // 7
+        return _grouped_mean(weeks, self.session_rates(), int(weeks[-1]) + 1)
+
+    def summary(self, threshold):
+        rates = self.student_rates()
+        streaks = self.longest_absence_streaks()
+        at_risk = self.at_risk(threshold)
+        return {
+            'class_id': self.class_id,
+            'students': len(self.user_ids),
+            'sessions': len(self.dates),
+            'mean_rate': _round(rates.mean()) if rates.size and self.dates.size else None,
+            'at_risk': [{'user_id': int(self.user_ids[i]), 'name': self.names[i],
+                         'rate': _round(rates[i]), 'longest_absence_streak': int(streaks[i])}
+                        for i in at_risk],
+            'weekday_rates': dict((WEEKDAYS[day], _round(rate))
+                                  for day, rate in enumerate(self.weekday_rates()) if not np.isnan(rate)),
+            # [week of term, rate] for the weeks that had sessions
+            'weekly_rates': [[week, _round(rate)]
+                             for week, rate in enumerate(self.weekly_rates()) if not np.isnan(rate)],
+        }
+
+
+def load_class_matrix(class_id):
+    for matrix in _matrices([class_id]):
+        return matrix
+    return AttendanceMatrix(class_id, np.zeros(0, dtype=np.int64), [],
+                            np.zeros(0, dtype='datetime64[D]'), np.zeros((0, 0), dtype=bool))
+
+
+# Yields the summary of every class, from one query streamed a class at a
+# time, so memory holds a single class's attendance however many there are
+def department_report(threshold, batch_size=10000):
+    for matrix in _matrices(None, batch_size):
+        yield matrix.summary(threshold)
+
+
+# Classes with enrolled students, the number of summaries department_report() yields
+def class_count():
+    return db.session.query(func.count(distinct(Enrollment.class_id))) \
+        .filter(Enrollment.dropped == False).scalar()
+
+
+# Yields an AttendanceMatrix per class with enrolled students, by class_id
+def _matrices(class_ids, batch_size=10000):
+    result = db.session.execute(_query(class_ids).execution_options(stream_results=True))
+    rows = _expanded(iter(lambda: result.fetchmany(batch_size), []))
+    for class_id, class_rows in groupby(rows, key=itemgetter(0)):
+        matrix = _build_matrix(class_id, list(class_rows))
+        # Sessions of a class everyone dropped
+        if matrix.user_ids.size:
+            yield matrix
+
+
+# (class_id, user_id, name, date, term, sessions) ordered by class_id. Live
+# check-ins have a date, archived ones a term and its bitmap. Every
+# enrolled student also has a row with neither, so students who never
+# attended are still part of the matrix. Rows without a user_id only add
+# their dates to the sessions: those of reports.session_dates() and
+# archived check-ins of students no longer enrolled.
+def _query(class_ids):
+    live = select([Enrollment.class_id.label('class_id'), Enrollment.user_id.label('user_id'),
+                   User.name.label('name'), Attendance.date.label('date'),
+                   null().label('term'), null().label('sessions')]) \
+        .select_from(Enrollment.__table__
+                     .join(User.__table__, User.user_id == Enrollment.user_id)
+                     .outerjoin(Attendance.__table__, and_(
+                         Attendance.class_id == Enrollment.class_id,
+                         Attendance.user_id == Enrollment.user_id))) \
+        .where(Enrollment.dropped == False)
+    archived = select([AttendanceArchive.class_id, Enrollment.user_id, User.name, null(),
+                       AttendanceArchive.term, AttendanceArchive.sessions]) \
+        .select_from(AttendanceArchive.__table__
+                     .outerjoin(Enrollment.__table__, and_(
+                         Enrollment.class_id == AttendanceArchive.class_id,
+                         Enrollment.user_id == AttendanceArchive.user_id,
+                         Enrollment.dropped == False))
+                     .outerjoin(User.__table__, User.user_id == Enrollment.user_id))
+    dates = session_dates(class_ids).alias('session_dates')
+    sessions = select([dates.c.class_id, null().label('user_id'), null().label('name'), dates.c.date,
+                       null().label('term'), null().label('sessions')])
+    if class_ids is not None:
+        live = live.where(Enrollment.class_id.in_(class_ids))
+        archived = archived.where(AttendanceArchive.class_id.in_(class_ids))
+    return union_all(live, archived, sessions).order_by(literal_column('class_id'))
+
+
+# Flattens batches of rows into (class_id, user_id, name, date), one row
+# per archived date
+def _expanded(batches):
+    for batch in batches:
+        for class_id, user_id, name, date, term, bitmap in batch:
+            if term is None:
+                yield class_id, user_id, name, date
+            else:
+                for archived_date in archive.dates(term, bitmap):
+                    yield class_id, user_id, name, archived_date
+
+
+def _build_matrix(class_id, rows):
+    sessions = np.unique(np.array([row[3] for row in rows if row[3] is not None], dtype='datetime64[D]'))
+    rows = [row for row in rows if row[1] is not None]
+    user_ids = np.array([row[1] for row in rows], dtype=np.int64)
+    dates = np.array([row[3] if row[3] is not None else np.datetime64('NaT') for row in rows],
+                     dtype='datetime64[D]')
+    students, first, student_index = np.unique(user_ids, return_index=True, return_inverse=True)
+    attended = ~np.isnat(dates)
+
+    present = np.zeros((len(students), len(sessions)), dtype=bool)
+    present[student_index[attended], np.searchsorted(sessions, dates[attended])] = True
+    return AttendanceMatrix(class_id, students, [rows[i][2] for i in first], sessions, present)
+
+
+def _grouped_mean(keys, values, size):
+    counts = np.bincount(keys, minlength=size).astype(float)
+    sums = np.bincount(keys, weights=values, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def _round(value):
+    return round(float(value), 3)
@@ -1,10 +1,18 @@
-from os import environ
+from os import environ, path
+import click
+import json
+import string
 from flask import Flask, url_for
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
+from database import Database
+from routing import RoutingSQLAlchemy
 
-# connection to database that is accessible by other parts of the application
-# mysql_db = Database()
+# Pooled raw SQL connection to the database that is accessible by other parts
+# of the application. Connections are only opened on first use.
+mysql_db = Database(
+    maxsize=int(environ.get('MYSQL_POOL_SIZE', 10)),
+    timeout=float(environ.get('MYSQL_POOL_TIMEOUT', 5))
+)
 
 login_manager = LoginManager()
 
@@ -22,12 +30,161 @@ app.config['SQLALCHEMY_DATABASE_URI'] = "mysql+pymysql://{username}:{password}@{
     db=environ.get('MYSQL_DB')
 )
 
-db = SQLAlchemy(app)
+# Attendance check-in ingest. 'sync' writes each check-in inside the request,
+# 'buffered' queues it and lets a background flusher batch the inserts
+app.config['ATTENDANCE_INGEST_MODE'] = environ.get('ATTENDANCE_INGEST_MODE', 'sync')
+app.config['ATTENDANCE_FLUSH_SIZE'] = int(environ.get('ATTENDANCE_FLUSH_SIZE', 200))
+app.config['ATTENDANCE_FLUSH_INTERVAL'] = float(environ.get('ATTENDANCE_FLUSH_INTERVAL', 0.5))
+app.config['ATTENDANCE_MAX_PENDING'] = int(environ.get('ATTENDANCE_MAX_PENDING', 10000))
+
+# Per-class enrollment membership cache used by check-ins
+app.config['ENROLLMENT_CACHE_TTL'] = int(environ.get('ENROLLMENT_CACHE_TTL', 300))
+app.config['ENROLLMENT_CACHE_SIZE'] = int(environ.get('ENROLLMENT_CACHE_SIZE', 1024))
+
+# Per-class attendance counters behind the teacher class page report
+app.config['ATTENDANCE_COUNTERS_TTL'] = int(environ.get('ATTENDANCE_COUNTERS_TTL', 300))
+app.config['ATTENDANCE_COUNTERS_SIZE'] = int(environ.get('ATTENDANCE_COUNTERS_SIZE', 1024))
+
+# Precompiled template bytecode shipped with the deployment, see
+# template_cache.py. Set to an empty string to disable.
+app.config['JINJA_BYTECODE_CACHE_DIR'] = environ.get(
+    'JINJA_BYTECODE_CACHE_DIR', path.join(path.dirname(path.abspath(__file__)), '.jinja_cache'))
+
+# Password hashing pool, see hashing.py. HASH_POOL_SIZE=0 hashes inline.
+app.config['PASSWORD_HASH_METHOD'] = environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000')
+app.config['HASH_POOL_SIZE'] = int(environ.get('HASH_POOL_SIZE', 2))
+app.config['HASH_QUEUE_DEPTH'] = int(environ.get('HASH_QUEUE_DEPTH', 32))
+app.config['HASH_TIMEOUT'] = float(environ.get('HASH_TIMEOUT', 5))
+
+# Authenticated requests build current_user from a snapshot kept in the
+# signed session instead of loading the user, see models.load_user
+app.config['USER_SNAPSHOT_MODE'] = environ.get('USER_SNAPSHOT_MODE', '1') == '1'
+app.config['USER_SNAPSHOT_TTL'] = int(environ.get('USER_SNAPSHOT_TTL', 300))
+
+# Enrollment and attendance codes, see codes.py. Codes are stored in
+# VARCHAR(50) columns so CODE_LENGTH may not exceed 50.
+app.config['CODE_LENGTH'] = min(int(environ.get('CODE_LENGTH', 50)), 50)
+app.config['CODE_ALPHABET'] = environ.get('CODE_ALPHABET', string.ascii_letters)
+app.config['CODE_RETRIES'] = int(environ.get('CODE_RETRIES', 5))
+
+# Rows per transaction when importing class rosters, see roster.py
+app.config['ROSTER_CHUNK_SIZE'] = int(environ.get('ROSTER_CHUNK_SIZE', 1000))
+
+# Students imported with a roster claim their account through a link emailed
+# to them, valid for CLAIM_TOKEN_MAX_AGE seconds, see claims.py. Without a
+# MAIL_SERVER the email is written to the log instead of being sent.
+app.config['CLAIM_TOKEN_MAX_AGE'] = int(environ.get('CLAIM_TOKEN_MAX_AGE', 7 * 24 * 3600))
+app.config['MAIL_SERVER'] = environ.get('MAIL_SERVER')
+app.config['MAIL_PORT'] = int(environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = environ.get('MAIL_USE_TLS', '1') == '1'
+app.config['MAIL_USERNAME'] = environ.get('MAIL_USERNAME')
+app.config['MAIL_PASSWORD'] = environ.get('MAIL_PASSWORD')
+app.config['MAIL_SENDER'] = environ.get('MAIL_SENDER', 'attendance@localhost')
+app.config['MAIL_TIMEOUT'] = float(environ.get('MAIL_TIMEOUT', 10))
+
+# Most records accepted by one batch check-in, see checkins.py
+app.config['ATTENDANCE_BATCH_MAX'] = int(environ.get('ATTENDANCE_BATCH_MAX', 5000))
+
+# Attendance exports, see exports.py. ADMIN_USER_IDS is a comma separated
+# list of teacher user_ids allowed to export every class.
+app.config['EXPORT_BATCH_SIZE'] = int(environ.get('EXPORT_BATCH_SIZE', 1000))
+app.config['ADMIN_USER_IDS'] = [int(user_id) for user_id in environ.get('ADMIN_USER_IDS', '').split(',') if user_id]
+
+# Students attending less than this share of sessions are flagged at risk
+app.config['AT_RISK_THRESHOLD'] = float(environ.get('AT_RISK_THRESHOLD', 0.75))
+
+# First day of each term as MM-DD, ascending. Attendance from closed terms is
+# compacted into AttendanceArchive by `flask compact-attendance`, see archive.py.
+app.config['TERM_STARTS'] = [tuple(int(part) for part in start.split('-'))
+                             for start in environ.get('TERM_STARTS', '01-01,07-01').split(',')]
+
+# Request instrumentation published on /metrics, see metrics.py
+app.config['METRICS_WINDOW'] = int(environ.get('METRICS_WINDOW', 1024))
+app.config['METRICS_SERVER_TIMING'] = environ.get('METRICS_SERVER_TIMING') == '1'
+
+# Admission control for check-ins and logins, see admission.py. Rates are
+# check-ins per second, 0 turns a bucket off. LOGIN_CONCURRENCY bounds the
+# logins looking up a user and checking a password at the same time.
+app.config['CHECKIN_CLASS_RATE'] = float(environ.get('CHECKIN_CLASS_RATE', 50))
+app.config['CHECKIN_CLASS_BURST'] = int(environ.get('CHECKIN_CLASS_BURST', 100))
+app.config['CHECKIN_GLOBAL_RATE'] = float(environ.get('CHECKIN_GLOBAL_RATE', 500))
+app.config['CHECKIN_GLOBAL_BURST'] = int(environ.get('CHECKIN_GLOBAL_BURST', 1000))
+app.config['CHECKIN_MAX_WAIT'] = float(environ.get('CHECKIN_MAX_WAIT', 2.0))
+app.config['CHECKIN_QUEUE_SIZE'] = int(environ.get('CHECKIN_QUEUE_SIZE', 200))
+app.config['LOGIN_CONCURRENCY'] = int(environ.get('LOGIN_CONCURRENCY', 8))
+app.config['LOGIN_QUEUE_SIZE'] = int(environ.get('LOGIN_QUEUE_SIZE', 32))
+app.config['LOGIN_MAX_WAIT'] = float(environ.get('LOGIN_MAX_WAIT', 2.0))
+
+# Memory cap of the rendered dashboard fragments, see page_cache.py
+app.config['PAGE_CACHE_MAX_BYTES'] = int(environ.get('PAGE_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+
+# Background jobs, see jobs.py. JOB_WORKERS threads per process run class
+# deletions, reports and compaction, at most JOB_QUEUE_SIZE jobs may be
+# running or waiting. 0 workers runs jobs inside the request. Jobs left
+# queued or running by a process that exited only run again through
+# `flask run-jobs`, schedule it when JOB_WORKERS is above 0.
+app.config['JOB_WORKERS'] = int(environ.get('JOB_WORKERS', 2))
+app.config['JOB_QUEUE_SIZE'] = int(environ.get('JOB_QUEUE_SIZE', 16))
+app.config['JOB_DELETE_CHUNK_SIZE'] = int(environ.get('JOB_DELETE_CHUNK_SIZE', 1000))
+app.config['JOB_STALE_SECONDS'] = int(environ.get('JOB_STALE_SECONDS', 600))
+
+# Live check-in updates, see pubsub.py. Set PUBSUB_BACKEND to 'socket' when
+# running several worker processes, with `flask pubsub-broker` listening on
+# PUBSUB_SOCKET. Each open class page holds one worker thread for up to
+# LIVE_STREAM_TIMEOUT seconds. LIVE_UPDATES=0 turns the event stream off for
+# platforms that buffer whole responses, such as API Gateway; the class page
+# then reloads itself every LIVE_REFRESH_SECONDS.
+app.config['LIVE_UPDATES'] = environ.get('LIVE_UPDATES', '1') == '1'
+app.config['LIVE_REFRESH_SECONDS'] = int(environ.get('LIVE_REFRESH_SECONDS', 30))
+app.config['PUBSUB_BACKEND'] = environ.get('PUBSUB_BACKEND', 'local')
+app.config['PUBSUB_SOCKET'] = environ.get('PUBSUB_SOCKET', '/tmp/attendance-pubsub.sock')
+app.config['LIVE_KEEPALIVE'] = float(environ.get('LIVE_KEEPALIVE', 15))
+app.config['LIVE_STREAM_TIMEOUT'] = float(environ.get('LIVE_STREAM_TIMEOUT', 600))
+
+# Check-ins, enrollment lookups and login lookups go through mysql_db
+# instead of the ORM when set
+app.config['RAW_SQL_HOT_PATHS'] = environ.get('RAW_SQL_HOT_PATHS') == '1'
+
+# Optional read replica for dashboards and reports, see routing.py. Either a
+# full REPLICA_DATABASE_URI or a MYSQL_REPLICA_HOST using the primary's
+# credentials. A replica that is down or more than REPLICA_MAX_LAG seconds
+# behind is skipped.
+replica_uri = environ.get('REPLICA_DATABASE_URI')
+if not replica_uri and environ.get('MYSQL_REPLICA_HOST'):
+    replica_uri = "mysql+pymysql://{username}:{password}@{host}:{port}/{db}?connect_timeout={timeout}".format(
+        username=environ.get('MYSQL_USER'),
+        password=environ.get('MYSQL_PASSWORD'),
+        host=environ.get('MYSQL_REPLICA_HOST'),
+        port=int(environ.get('MYSQL_REPLICA_PORT', 3306)),
+        db=environ.get('MYSQL_DB'),
+        timeout=int(environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+    )
+if replica_uri:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': replica_uri}
+app.config['REPLICA_MAX_LAG'] = float(environ.get('REPLICA_MAX_LAG', 5))
+app.config['REPLICA_CHECK_INTERVAL'] = float(environ.get('REPLICA_CHECK_INTERVAL', 5))
+app.config['REPLICA_LAG_QUERY'] = environ.get('REPLICA_LAG_QUERY')
+app.config['READ_YOUR_WRITES_SECONDS'] = float(environ.get('READ_YOUR_WRITES_SECONDS', 10))
+
+# The engine and its connections are only created on the first database use.
+# Sessions route reads to the replica where allowed, see routing.py.
+db = RoutingSQLAlchemy(app)
 
 # Initializes all necessary items for app to function
 with app.app_context():
     from auth_routes import auth
     from common_routes import common
+    from ingest import ingest
+    from enrollment_cache import enrollment_cache
+    from reports import attendance_counters
+    from metrics import metrics
+    from hashing import password_hasher
+    from pubsub import pubsub
+    from admission import admission
+    from routing import replica_router
+    from page_cache import page_cache
+    from jobs import jobs
+    import template_cache
 
     app.register_blueprint(auth)
     app.register_blueprint(common)
@@ -35,3 +192,78 @@ with app.app_context():
     # db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
+    ingest.init_app(app)
+    enrollment_cache.init_app(app)
+    attendance_counters.init_app(app)
+    metrics.init_app(app)
+    metrics.register_collector('enrollment_cache', enrollment_cache.stats)
+    metrics.register_collector('ingest', lambda: {'pending': ingest.pending_count()})
+    pubsub.init_app(app)
+    metrics.register_collector('pubsub', pubsub.stats)
+    admission.init_app(app)
+    metrics.register_collector('admission', admission.stats)
+    replica_router.init_app(app)
+    metrics.register_collector('replica', replica_router.stats)
+    jobs.init_app(app)
+    metrics.register_collector('jobs', jobs.stats)
+    template_cache.init_app(app)
+    password_hasher.init_app(app)
+    page_cache.init_app(app)
+    metrics.register_collector('page_cache', page_cache.stats)
+
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Precompile templates into the Jinja bytecode cache before deploying."""
+    import template_cache
+    for name in template_cache.compile_templates(app):
+        print(name)
+
+
+@app.cli.command('import-roster')
+@click.argument('class_id', type=int)
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+def import_roster_command(class_id, csv_file):
+    """Import a CSV roster (name, email) into a class."""
+    from roster import import_roster
+    summary = import_roster(class_id, csv_file)
+    enrollment_cache.invalidate(class_id)
+    attendance_counters.invalidate(class_id)
+    print(json.dumps(summary, indent=2))
+
+
+@app.cli.command('attendance-report')
+@click.option('--threshold', type=float, help='At-risk attendance rate, defaults to AT_RISK_THRESHOLD')
+def attendance_report_command(threshold):
+    """Print a JSON lines attendance summary of every class."""
+    import analytics
+    threshold = app.config['AT_RISK_THRESHOLD'] if threshold is None else threshold
+    for summary in analytics.department_report(threshold):
+        print(json.dumps(summary))
+
+
+@app.cli.command('pubsub-broker')
+def pubsub_broker_command():
+    """Relay live check-in updates between worker processes."""
+    from pubsub import Broker
+    broker = Broker(app.config['PUBSUB_SOCKET'])
+    print('Relaying on {0}'.format(app.config['PUBSUB_SOCKET']))
+    try:
+        broker.serve_forever()
+    finally:
+        broker.server_close()
+
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Run queued background jobs, including those of workers that died."""
+    from jobs import jobs
+    requeued = jobs.requeue_stale()
+    print(json.dumps({'requeued': requeued, 'ran': jobs.run_pending()}))
+
+
+@app.cli.command('compact-attendance')
+def compact_attendance_command():
+    """Move attendance from closed terms into the bitmap archive."""
+    import archive
+    print(json.dumps(archive.compact()))
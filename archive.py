@@ -0,0 +1,188 @@
+from collections import defaultdict
+from flask import current_app
+from models import db, User, Classes, Attendance, AttendanceArchive
+from sqlalchemy import distinct, tuple_
+import datetime
+
+# Compact bitmap storage for the attendance of closed terms.
+# compact() rolls every Attendance row dated before the current term into
+# AttendanceArchive, one row per (class, student, term) whose `sessions`
+# bitmap has bit i set when the student attended on day i of the term, then
+# deletes exactly the rows it rolled up, so a check-in written for a closed
+# term in the meantime stays live until the next run. The read helpers below let the duplicate check
+# and the reports look at both stores; live rows and archived rows never
+# overlap because only whole closed terms are compacted.
+#
+# Terms begin on the (month, day) pairs in TERM_STARTS. A term is identified
+# as year * 10 + its position in TERM_STARTS, e.g. 20262 for the second term
+# of 2026. The column holds 32 bytes, enough for terms of up to 256 days; a
+# class with attendance beyond that is left alone and listed as skipped.
+
+BITMAP_BITS = 256
+# (user_id, date) keys per DELETE of compacted rows
+DELETE_CHUNK_SIZE = 500
+
+
+class TermTooLong(ValueError):
+    pass
+
+
+# Returns (term, first day of the term) for a date
+def term_of(date):
+    starts = current_app.config['TERM_STARTS']
+    for index in range(len(starts) - 1, -1, -1):
+        start = datetime.date(date.year, *starts[index])
+        if date >= start:
+            return date.year * 10 + index + 1, start
+    # Before the first term start of the year, so in last year's final term
+    return (date.year - 1) * 10 + len(starts), datetime.date(date.year - 1, *starts[-1])
+
+
+def term_start(term):
+    year, index = divmod(term, 10)
+    return datetime.date(year, *current_app.config['TERM_STARTS'][index - 1])
+
+
+# Everything dated before this belongs to a closed term
+def open_term_start(today=None):
+    return term_of(today or datetime.date.today())[1]
+
+
+def encode(bits):
+    return bits.to_bytes(max(1, (bits.bit_length() + 7) // 8), 'little')
+
+
+def decode(bitmap):
+    return int.from_bytes(bitmap, 'little')
+
+
+def popcount(bitmap):
+    return bin(decode(bitmap)).count('1')
+
+
+# Dates whose bit is set in a term's bitmap, ascending
+def dates(term, bitmap):
+    start = term_start(term)
+    bits = decode(bitmap)
+    result = []
+    while bits:
+        lowest = bits & -bits
+        result.append(start + datetime.timedelta(days=lowest.bit_length() - 1))
+        bits ^= lowest
+    return result
+
+
+# Duplicate check against the archive. Dates of the open term are never
+# archived, so checking today's attendance costs no query.
+def is_archived(class_id, user_id, date):
+    if date >= open_term_start():
+        return False
+    term, start = term_of(date)
+    bitmap = db.session.query(AttendanceArchive.sessions) \
+        .filter_by(class_id=class_id, user_id=user_id, term=term) \
+        .scalar()
+    return bitmap is not None and bool(decode(bitmap) >> (date - start).days & 1)
+
+
+# Returns {class_id: (sessions, {user_id: attended})} from one query, where
+# sessions counts the archived days anyone in the class attended
+def archived_counts(class_ids):
+    rows = db.session.query(AttendanceArchive.class_id, AttendanceArchive.user_id,
+                            AttendanceArchive.term, AttendanceArchive.sessions) \
+        .filter(AttendanceArchive.class_id.in_(class_ids)) \
+        .all()
+    held = defaultdict(int)
+    attended = defaultdict(lambda: defaultdict(int))
+    for class_id, user_id, term, bitmap in rows:
+        held[(class_id, term)] |= decode(bitmap)
+        attended[class_id][user_id] += popcount(bitmap)
+
+    sessions = defaultdict(int)
+    for (class_id, term), bits in held.items():
+        sessions[class_id] += bin(bits).count('1')
+    return dict((class_id, (sessions[class_id], dict(attended[class_id]))) for class_id in attended)
+
+
+# Same columns as exports.attendance_rows(), expanded from the archive
+def archived_export_rows(class_id=None, batch_size=1000):
+    query = db.session.query(
+        AttendanceArchive.class_id, Classes.name, Classes.section,
+        AttendanceArchive.user_id, User.name, User.email,
+        AttendanceArchive.term, AttendanceArchive.sessions) \
+        .join(Classes, Classes.class_id == AttendanceArchive.class_id) \
+        .join(User, User.user_id == AttendanceArchive.user_id)
+    if class_id is not None:
+        query = query.filter(AttendanceArchive.class_id == class_id)
+    query = query.order_by(AttendanceArchive.class_id, AttendanceArchive.user_id, AttendanceArchive.term) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+    for row in query:
+        for date in dates(row[6], row[7]):
+            yield tuple(row[:6]) + (date,)
+
+
+# Rolls all closed terms from Attendance into AttendanceArchive, one class
+# and one transaction at a time. Returns counts of what was done.
+def compact(today=None, progress=None):
+    cutoff = open_term_start(today)
+    class_ids = [row[0] for row in db.session.query(distinct(Attendance.class_id))
+                 .filter(Attendance.date < cutoff)]
+    summary = {'classes': 0, 'rows': 0, 'cutoff': cutoff.isoformat(), 'skipped': []}
+    for done, class_id in enumerate(class_ids, start=1):
+        try:
+            summary['rows'] += compact_class(class_id, cutoff)
+            summary['classes'] += 1
+        except TermTooLong as error:
+            summary['skipped'].append({'class_id': class_id, 'error': str(error)})
+        if progress is not None:
+            progress(done, len(class_ids))
+    return summary
+
+
+def compact_class(class_id, cutoff):
+    rows = db.session.query(Attendance.user_id, Attendance.date) \
+        .filter(Attendance.class_id == class_id, Attendance.date < cutoff) \
+        .all()
+    if not rows:
+        return 0
+
+    terms = {}
+    bitmaps = defaultdict(int)
+    for user_id, date in rows:
+        if date not in terms:
+            terms[date] = term_of(date)
+        term, start = terms[date]
+        offset = (date - start).days
+        if offset >= BITMAP_BITS:
+            raise TermTooLong('Term {0} is longer than {1} days'.format(term, BITMAP_BITS))
+        bitmaps[(user_id, term)] |= 1 << offset
+
+    try:
+        # Terms compacted before (rows that arrived late) are merged, not replaced
+        existing = db.session.query(AttendanceArchive.user_id, AttendanceArchive.term, AttendanceArchive.sessions) \
+            .filter(AttendanceArchive.class_id == class_id,
+                    AttendanceArchive.term.in_(set(term for user_id, term in bitmaps))) \
+            .all()
+        updates = []
+        for user_id, term, bitmap in existing:
+            if (user_id, term) in bitmaps:
+                updates.append({'class_id': class_id, 'user_id': user_id, 'term': term,
+                                'sessions': encode(decode(bitmap) | bitmaps.pop((user_id, term)))})
+        if updates:
+            db.session.bulk_update_mappings(AttendanceArchive, updates)
+        if bitmaps:
+            db.session.execute(AttendanceArchive.__table__.insert(), [
+                {'class_id': class_id, 'user_id': user_id, 'term': term, 'sessions': encode(bits)}
+                for (user_id, term), bits in bitmaps.items()])
+
+        # Only the rows read above, not whatever matches the cutoff by now
+        for start in range(0, len(rows), DELETE_CHUNK_SIZE):
+            keys = [(user_id, date) for user_id, date in rows[start:start + DELETE_CHUNK_SIZE]]
+            Attendance.query.filter(Attendance.class_id == class_id,
+                                    tuple_(Attendance.user_id, Attendance.date).in_(keys)) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows)
@@ -1,11 +1,26 @@
-from forms import LoginForm, RegistrationForm
-from models import db, login_manager, login_required, User, Classes, Enrollment, Attendance
-from flask import Blueprint, flash, get_flashed_messages, redirect, render_template, request, url_for, jsonify
+from models import db, login_manager, login_required, bump_content_version, store_user_snapshot, User, Classes, Enrollment, \
+    Attendance, Job
+from app import mysql_db
+from codes import assign_unique_code, class_id_for_enrollment_code
+from claims import claim, is_placeholder, send_claim_link, user_for_token
+from hashing import password_hasher, HashingBusy
+from ingest import ingest
+from enrollment_cache import enrollment_cache
+from reports import attendance_counters
+from pubsub import pubsub
+from admission import admission, Shed
+from routing import read_only, replica_router
+from page_cache import page_cache
+from jobs import jobs, describe, JobsBusy
+from checkins import check_in_batch, BatchTooLarge
+import archive
+from flask import Blueprint, Response, abort, current_app, flash, get_flashed_messages, make_response, redirect, \
+    render_template, request, session, stream_with_context, url_for, jsonify
 from flask_login import current_user, login_user, logout_user
-from werkzeug.security import check_password_hash, generate_password_hash
-import random
-import string
 import datetime
+import io
+import json
+import time
 
 # Blueprint that will register 'auth' or authentication routes
 # Routes that will require user authentication or depend on
@@ -18,20 +33,32 @@ def login():
     if current_user.is_authenticated:
         return redirect(url_for('common.index'))
 
+    # WTForms is only imported once a form is actually needed, it is a large
+    # part of the import time on a cold start
+    from forms import LoginForm
     form = LoginForm()
 
     if request.method == 'POST':
         if form.validate_on_submit():
             # Queries datebase to make sure a user with that email exists
             # then checks hashed password from field against User object
-            # password_hash
-            user = User.query.filter_by(email=form.email.data).first()
-
-            if user is None or not user.check_password(form.password.data):
+            # password_hash. Only LOGIN_CONCURRENCY logins do so at a time,
+            # see admission.py.
+            try:
+                with admission.login_slot():
+                    user = find_user_by_email(form.email.data)
+                    valid = user is not None and user.check_password(form.password.data)
+            except (Shed, HashingBusy) as error:
+                retry_after = error.retry_after_header if isinstance(error, Shed) else '1'
+                flash('The server is busy, please try again in a moment.', category='failure')
+                return render_template('login.html', form=form, title='Login'), 503, {'Retry-After': retry_after}
+            if not valid:
                 flash('Invalid Credentials.', category='failure')
                 return redirect(url_for('auth.login'))
 
+            rehash_password(user, form.password.data)
             login_user(user)
+            store_user_snapshot(user)
 
             if user.user_type == 'student':
                 return redirect(url_for('auth.student_dashboard'))
@@ -43,6 +70,7 @@ def login():
 # Handles the registrations of users
 @auth.route('/register', methods=['GET', 'POST'])
 def register():
+    from forms import RegistrationForm
     form = RegistrationForm()
 
     if request.method == 'POST':
@@ -54,11 +82,30 @@ def register():
             user_exists = User.query.filter(
                 User.email == form.email.data).first()
 
+            # Students imported with a class roster already have an account
+            # without a usable password (see roster.py). It is only handed
+            # over through a link sent to its email, see claims.py.
+            if user_exists and is_placeholder(user_exists):
+                try:
+                    send_claim_link(user_exists)
+                except OSError:
+                    current_app.logger.exception('Claim link for user %d not sent', user_exists.user_id)
+                    flash('The email could not be sent, please try again in a moment.', category='failure')
+                    return redirect(url_for('auth.register'))
+                flash('Your teacher already created your account. We sent you an email with a link '
+                      'to set your password.', category='success')
+                return redirect(url_for('auth.login'))
+
             if user_exists:
                 flash('A user with that email already exists', category='failure')
                 return redirect(url_for('auth.register'))
 
-            hashed_pass = generate_password_hash(form.password.data)
+            try:
+                hashed_pass = password_hasher.generate(form.password.data)
+            except HashingBusy:
+                flash('The server is busy, please try again in a moment.', category='failure')
+                return render_template('register.html', form=form, title='Register'), 503, {'Retry-After': '1'}
+
             new_user = User(name=form.name.data,
                             email=form.email.data,
                             password_hash=hashed_pass,
@@ -72,80 +119,138 @@ def register():
 
     return render_template('register.html', form=form, title='Register')
 
+# Sets the name and password of an account created by a roster import, for
+# whoever opened the link register() emailed, see claims.py
+@auth.route('/claim/<token>', methods=['GET', 'POST'])
+def claim_account(token):
+    from forms import ClaimForm
+    user = user_for_token(token)
+    if user is None:
+        flash('This link is invalid, has expired or was already used.', category='failure')
+        return redirect(url_for('auth.register'))
+    form = ClaimForm(name=user.name)
+
+    if form.validate_on_submit():
+        try:
+            hashed_pass = password_hasher.generate(form.password.data)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.', category='failure')
+            return render_template('claim.html', form=form, token=token, email=user.email,
+                                   title='Set up your account'), 503, {'Retry-After': '1'}
+
+        if not claim(user, form.name.data, hashed_pass):
+            flash('This link is invalid, has expired or was already used.', category='failure')
+            return redirect(url_for('auth.register'))
+        flash('Your account is ready, you can log in now.', category='success')
+        return redirect(url_for('auth.login'))
+
+    return render_template('claim.html', form=form, token=token, email=user.email, title='Set up your account')
+
 # Handles the logout of users
 @auth.route('/logout')
 @login_required(role="ANY")
 def logout():
     logout_user()
+    session.pop('user_snapshot', None)
     return redirect(url_for('common.index'))
 
 # The route for student dashboard
 # See logic/models.py for more infor on @login_required decorator
 @auth.route('/student_dashboard', methods=['POST', 'GET'])
 @login_required(role='student')
+@read_only
 def student_dashboard():
-    enrollment_obj = Enrollment.query.filter_by(user_id=current_user.user_id).all()
-    classes = [Classes.query.get(enroll.get_class_id()) 
-               for enroll in enrollment_obj]
     if request.method == 'POST':
         enrollment_code = request.form['enrollment_code']
         # Add a new enrollment to the Enrollment table
-        class_id = Classes.query.filter_by(
-            enrollment_code=enrollment_code).first().get_id()
+        class_id = validate_registration(enrollment_code)
+        if class_id is None:
+            # Shown on the dashboard itself, which does not render flashes
+            return student_dashboard_page('Invalid enrollment code.'), 400
         new_enrollment = Enrollment(
             class_id=class_id,
             user_id=current_user.user_id,
             dropped=False
         )
         db.session.add(new_enrollment)
+        bump_content_version([current_user.user_id])
         db.session.commit()
-        flash('Registration Successful!', category='success')
+        enrollment_cache.invalidate(class_id)
+        attendance_counters.invalidate(class_id)
         return redirect(url_for('auth.student_class_page', id=class_id))
 
-    return render_template('student_dashboard.html', title='Student Dashboard', classes=classes)
+    # An unchanged dashboard costs one lookup of the user's content_version
+    # and a 304, see page_cache.py
+    version = db.session.query(User.content_version).filter_by(user_id=current_user.user_id).scalar()
+    etag = page_cache.etag('student', current_user.user_id, version)
+    not_modified = page_cache.not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+
+    response = make_response(student_dashboard_page(version=version))
+    return page_cache.conditional(response, etag)
+
+
+# The student dashboard, with an error from the enrollment form if any
+def student_dashboard_page(error=None, version=None):
+    if version is None:
+        version = db.session.query(User.content_version).filter_by(user_id=current_user.user_id).scalar()
+    # All of the student's classes in one joined query, on a fragment cache miss
+    class_list = page_cache.fragment(('student', current_user.user_id, version), lambda: render_template(
+        '_student_class_list.html',
+        classes=Classes.query.join(Enrollment).filter(Enrollment.user_id == current_user.user_id).all()))
+    return render_template('student_dashboard.html', title='Student Dashboard', class_list=class_list,
+                           error=error)
 
 # The route for teacher dashboard
 # See logic/models.py for more infor on @login_required decorator
 @auth.route('/teacher_dashboard', methods=['POST', 'GET'])
 @login_required(role='teacher')
+@read_only
 def teacher_dashboard():
-    class_obj = Classes.query.filter_by(
-        professor_id=current_user.user_id)
-
-    class_list = []
-    for c in class_obj:
-        class_info = (c.get_id(), c.get_name(), c.get_section())
-        class_list.append(class_info)
-
     if request.method == 'POST':
         # if add_class is clicked
         # get class name and section, generate registration code, and add a new class to database, redirect
         if 'add_class' in request.form:
-            # generate random registration code
-            registration_code = get_code()
-
-            # add class to database
+            # add class to database with a random registration code,
+            # regenerated if it collides with an existing one
             new_class = Classes(
                 name=request.form['class_name'],
                 section=request.form['class_section'],
-                enrollment_code=registration_code,
                 professor_id=current_user.user_id
             )
-            db.session.add(new_class)
+            assign_unique_code(new_class, 'enrollment_code')
+            bump_content_version([current_user.user_id])
             db.session.commit()
 
-            class_added = Classes.query.filter_by(
-                professor_id=current_user.user_id, name=new_class.name, section=new_class.section).first()
-            class_id = class_added.get_id()
+            class_id = new_class.get_id()
             return redirect(url_for('auth.teacher_class_page', id=class_id))
         else:
             class_id = request.form[class_id]
             return redirect(url_for('auth.teacher_class_page', id=class_id))
-    return render_template('teacher_dashboard.html', title='Teacher Dashboard', class_list=class_list)
+
+    # Same conditional response and fragment cache as the student dashboard
+    version = db.session.query(User.content_version).filter_by(user_id=current_user.user_id).scalar()
+    etag = page_cache.etag('teacher', current_user.user_id, version)
+    not_modified = page_cache.not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+
+    # Only the columns shown on the dashboard, in one query
+    class_list = page_cache.fragment(('teacher', current_user.user_id, version), lambda: render_template(
+        '_teacher_class_list.html',
+        class_list=db.session.query(Classes.class_id, Classes.name, Classes.section)
+        .filter_by(professor_id=current_user.user_id)
+        .all()))
+
+    response = make_response(render_template('teacher_dashboard.html', title='Teacher Dashboard',
+                                             class_list=class_list))
+    return page_cache.conditional(response, etag)
 
 # Route for teacher metrics and information for an individual clas
 @auth.route('/teacher_class_page/<id>', methods=['GET', 'POST'])
 @login_required(role='teacher')
+@read_only
 def teacher_class_page(id):
     # Get current class info
     current_class = Classes.query.filter_by(class_id=id).first()
@@ -159,22 +264,156 @@ def teacher_class_page(id):
             if current_class.get_attendance_code():
                 # there is already an attendance code, delete it
                 current_class.attendance_code = None
-                db.session.commit()
             else:
                 # there is no code, generate it
-                attendance_code = get_code()
-                current_class.attendance_code = attendance_code
-                db.session.commit()
-        if 'del_class' in request.form:
-            db.session.delete(current_class)
+                attendance_code = assign_unique_code(current_class, 'attendance_code')
+            # Any change to a class refreshes its teacher's dashboard
+            bump_content_version([current_class.professor_id])
             db.session.commit()
+        if 'del_class' in request.form:
+            # Deleted in the background in chunks, the dashboards of the
+            # teacher and the enrolled students drop it once that is done,
+            # see jobs.py
+            try:
+                jobs.submit('delete_class', owner_id=current_user.user_id, class_id=current_class.get_id())
+            except JobsBusy:
+                return 'The server is busy, please try again in a moment.', 503, {'Retry-After': '5'}
             return redirect(url_for('auth.teacher_dashboard'))
 
-    return render_template('teacher_class_page.html', current_class=current_class, registration_code=registration_code, attendance_code=attendance_code)
+    # (name, percentage, attended, total) per enrolled student, see reports.py
+    attendance_records = attendance_counters.report(current_class.get_id())
+    # Answered by the counters the report just warmed, no query
+    day, present = attendance_counters.present(current_class.get_id())
+
+    return render_template('teacher_class_page.html', current_class=current_class, registration_code=registration_code,
+                           attendance_code=attendance_code, attendance_records=attendance_records,
+                           at_risk_percentage=100 * current_app.config['AT_RISK_THRESHOLD'],
+                           present_names=sorted(name for name in present.values() if name),
+                           live_updates=current_app.config['LIVE_UPDATES'],
+                           refresh_seconds=current_app.config['LIVE_REFRESH_SECONDS'])
+
+# Imports a CSV roster (name, email) into the class, creating missing student
+# accounts. Returns a JSON summary with per-row errors, see roster.py.
+@auth.route('/teacher_class_page/<int:id>/roster', methods=['POST'])
+@login_required(role='teacher')
+def import_class_roster(id):
+    if not Classes.query.filter_by(class_id=id, professor_id=current_user.user_id).first():
+        abort(404)
+    upload = request.files.get('roster')
+    if upload is None:
+        return jsonify({'errors': [{'row': 0, 'error': 'No roster file uploaded'}]}), 400
+
+    # The upload is decoded and parsed as it is read, never held in memory
+    # whole. The csv module is only imported once a roster is uploaded.
+    from roster import decode_lines, import_roster
+    summary = import_roster(id, decode_lines(upload.stream))
+    enrollment_cache.invalidate(id)
+    attendance_counters.invalidate(id)
+    return jsonify(summary)
+
+
+# Full attendance history of one class as a streamed CSV or JSON lines download
+@auth.route('/teacher_class_page/<int:id>/export.<any(csv, jsonl):fmt>')
+@login_required(role='teacher')
+@read_only
+def export_class_attendance(id, fmt):
+    if not Classes.query.filter_by(class_id=id, professor_id=current_user.user_id).first():
+        abort(404)
+    return export_response(fmt, 'class-{0}-attendance'.format(id), id)
+
+# Per-student and per-session statistics for one class, see analytics.py
+@auth.route('/teacher_class_page/<int:id>/analytics')
+@login_required(role='teacher')
+@read_only
+def class_analytics(id):
+    if not Classes.query.filter_by(class_id=id, professor_id=current_user.user_id).first():
+        abort(404)
+    # NumPy is only imported when analytics are asked for, not at startup
+    import analytics
+    matrix = analytics.load_class_matrix(id)
+    return jsonify(matrix.summary(current_app.config['AT_RISK_THRESHOLD']))
+
+# Starts a background analytics report of the class, answered with 202 and
+# the job to follow on /jobs/<job_id>
+@auth.route('/teacher_class_page/<int:id>/report', methods=['POST'])
+@login_required(role='teacher')
+def class_report(id):
+    if not Classes.query.filter_by(class_id=id, professor_id=current_user.user_id).first():
+        abort(404)
+    return job_response('attendance_report', threshold=report_threshold(), class_id=id)
+
+# Server-sent events for the class page: a snapshot of who is present today,
+# then one event per new check-in with the running count. One long-lived
+# connection instead of reloading the page. The stream ends after
+# LIVE_STREAM_TIMEOUT seconds and the browser reconnects on its own. Not
+# available with LIVE_UPDATES off, the page reloads itself instead.
+@auth.route('/teacher_class_page/<int:id>/live')
+@login_required(role='teacher')
+def live_attendance(id):
+    if not current_app.config['LIVE_UPDATES']:
+        abort(404)
+    if not Classes.query.filter_by(class_id=id, professor_id=current_user.user_id).first():
+        abort(404)
+    # Subscribed before reading the snapshot so no check-in falls in between
+    subscription = pubsub.subscribe(live_channel(id))
+    day, present = attendance_counters.present(id)
+    response = Response(live_events(subscription, day, present,
+                                    current_app.config['LIVE_KEEPALIVE'],
+                                    current_app.config['LIVE_STREAM_TIMEOUT']),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(subscription.close)
+    return response
+
+
+# Attendance of every class, for the teachers listed in ADMIN_USER_IDS
+@auth.route('/admin/export.<any(csv, jsonl):fmt>')
+@login_required(role='teacher')
+@read_only
+def export_all_attendance(fmt):
+    if current_user.user_id not in current_app.config['ADMIN_USER_IDS']:
+        abort(403)
+    return export_response(fmt, 'attendance', None)
+
+
+# Analytics report of every class as a background job, for administrators
+@auth.route('/admin/report', methods=['POST'])
+@login_required(role='teacher')
+def department_report():
+    if current_user.user_id not in current_app.config['ADMIN_USER_IDS']:
+        abort(403)
+    return job_response('attendance_report', threshold=report_threshold())
+
+# Moves attendance of closed terms into the archive in the background, the
+# same as `flask compact-attendance`
+@auth.route('/admin/compact', methods=['POST'])
+@login_required(role='teacher')
+def compact_attendance():
+    if current_user.user_id not in current_app.config['ADMIN_USER_IDS']:
+        abort(403)
+    return job_response('compact_attendance')
+
+# Status, progress and, once done, result of a job the user started
+@auth.route('/jobs/<int:id>')
+@login_required(role='ANY')
+def job_status(id):
+    job = Job.query.get(id)
+    if job is None or (job.owner_id != current_user.user_id and
+                       current_user.user_id not in current_app.config['ADMIN_USER_IDS']):
+        abort(404)
+    return jsonify(describe(job))
+
+# The user's latest jobs, newest first
+@auth.route('/jobs')
+@login_required(role='ANY')
+def list_jobs():
+    return jsonify([describe(job) for job in Job.query.filter_by(owner_id=current_user.user_id)
+                    .order_by(Job.job_id.desc()).limit(20)])
 
 
 @auth.route('/student_class_page/<id>', methods=['GET', 'POST'])
 @login_required(role='student')
+@read_only
 def student_class_page(id):
     #query classes and get class info
     current_class = Classes.query.filter_by(class_id=id).first()
@@ -194,11 +433,14 @@ def student_class_page(id):
     #     else:
         # Unenroll from a class
         Enrollment.query.filter_by(class_id=id, user_id=current_user.user_id).delete()
+        bump_content_version([current_user.user_id])
         db.session.commit()
+        enrollment_cache.invalidate(int(id))
+        attendance_counters.invalidate(int(id))
         return redirect(url_for('auth.student_dashboard'))
     return render_template('student_class_page.html', current_class=current_class)
 
-@auth.route('/mark_attendance/<id>', methods=['GET'])
+@auth.route('/mark_attendance/<int:id>', methods=['GET'])
 @login_required(role='student')
 def mark_attendance(id):
     class_id, user_id, date = id, current_user.user_id, datetime.date.today()
@@ -208,53 +450,179 @@ def mark_attendance(id):
         'date': date,
         'already_marked': False
     }
-    
-    def is_enrolled():
-        enroll = Enrollment.query.filter_by(user_id=user_id, class_id=id, dropped=False).all()
-        if enroll:
-            return True
-        return False
-    if not is_enrolled():
+
+    # Waits for a check-in token or is turned away before touching the
+    # database, see admission.py. Clients retry after Retry-After.
+    try:
+        admission.admit_check_in(class_id)
+    except Shed as shed:
+        response.update(success=False, retry_after=shed.retry_after_header)
+        return jsonify(response), shed.status, {'Retry-After': shed.retry_after_header}
+
+    # Answered from the per-class membership cache, see enrollment_cache.py
+    if not enrollment_cache.is_enrolled(class_id, user_id):
         response['success'] = False
         return jsonify(response)
-        
-    if not Attendance.query.filter_by(
-        class_id=class_id, user_id=user_id, date=date).all():
-        
-        new_attendance = Attendance(
-            class_id=id,
-            user_id=current_user.user_id,
-            date=datetime.date.today()
-        )
-        db.session.add(new_attendance)
-        db.session.commit()
-        response['success'] = True
-    else:
-        response['success'] = True
+
+    # Written right away or handed to the write-behind buffer depending on
+    # ATTENDANCE_INGEST_MODE, see ingest.py. Dates in closed terms live in
+    # the archive, the check is free for dates of the open term.
+    response['success'] = True
+    if (attendance_counters.is_present(class_id, user_id, date)
+            or archive.is_archived(class_id, user_id, date)
+            or not ingest.submit(class_id, user_id, date)):
         response['already_marked'] = True
+    else:
+        attendance_counters.record(class_id, user_id, date)
+        # Queued or raw SQL check-ins are not seen by the session
+        replica_router.stick_to_primary()
+        # Feeds the live counters on the teacher's class page
+        pubsub.publish(live_channel(class_id), {
+            'user_id': user_id, 'name': current_user.name, 'date': date.isoformat()})
     return jsonify(response)
         
 
-# generate random registration or attendance code: helper_code
-def get_code():
-    code = ""
-    for i in range(50):
-        code += (random.choice(string.ascii_letters))
-    code = check_unique_code(code)
-    return code
-
-# check for unique registration code when generating
-
-
-def check_unique_code(code):
-    duplicate = Classes.query.filter_by(enrollment_code=code).first()
-    while duplicate:
-        code = get_code()
-        duplicate = Classes.query.filter_by(enrollment_code=new_code).first()
-    return code
-
+# Check-ins recorded offline by a kiosk or scanner, synced in one request.
+# The body is a JSON array (or {"records": [...]}) or NDJSON of records
+# with class_id, user_id and an ISO date, for classes the teacher teaches;
+# administrators may sync any class. Answers with counts and one result
+# code per record in the order sent, see checkins.py.
+@auth.route('/attendance/batch', methods=['POST'])
+@login_required(role='teacher')
+def batch_check_in():
+    # Neither type can be sent by a plain cross-site form post
+    if not request.is_json and request.mimetype not in NDJSON_MIMETYPES:
+        return jsonify({'error': 'Send application/json or application/x-ndjson'}), 415
+    try:
+        records = batch_records(current_app.config['ATTENDANCE_BATCH_MAX'])
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    admin = current_user.user_id in current_app.config['ADMIN_USER_IDS']
+    try:
+        results, counts = check_in_batch(records, None if admin else current_user.user_id)
+    except BatchTooLarge as error:
+        return jsonify({'error': str(error)}), 413
+    if counts['inserted']:
+        # Raw SQL inserts are not seen by the session
+        replica_router.stick_to_primary()
+    return jsonify({'counts': counts, 'results': results})
+        
 
+def live_channel(class_id):
+    return 'attendance:{0}'.format(class_id)
+
+
+# Runs outside the request, holding no database connection while it waits
+def live_events(subscription, day, present, keepalive, timeout):
+    deadline = time.time() + timeout
+    yield sse_event('snapshot', {'date': day.isoformat(), 'present': len(present),
+                                 'names': sorted(name for name in present.values() if name)})
+    while time.time() < deadline:
+        message = subscription.get(timeout=keepalive)
+        if message is None:
+            # Comment line, keeps proxies from closing an idle connection
+            yield ': keepalive\n\n'
+            continue
+        if message['date'] != day.isoformat():
+            # First check-in of a new day starts the count over
+            day, present = datetime.date.fromisoformat(message['date']), {}
+            yield sse_event('snapshot', {'date': message['date'], 'present': 0, 'names': []})
+        if message['user_id'] in present:
+            continue
+        present[message['user_id']] = message['name']
+        yield sse_event('checkin', {'date': message['date'], 'present': len(present), 'name': message['name']})
+
+
+def sse_event(event, data):
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data))
+
+
+# Login lookup. With RAW_SQL_HOT_PATHS the row comes from the raw SQL pool
+# and is wrapped in a detached User without going through a Query.
+def find_user_by_email(email):
+    if current_app.config['RAW_SQL_HOT_PATHS']:
+        row = mysql_db.get_existing_user(email)
+        return User(**row) if row else None
+    return User.query.filter_by(email=email).first()
+
+
+# Upgrades a password hash made with outdated parameters after a successful
+# login, while the cleartext is at hand. Skipped when the hashing pool is
+# busy, the next login will try again.
+def rehash_password(user, cleartext):
+    if not password_hasher.needs_rehash(user.password_hash):
+        return
+    try:
+        new_hash = password_hasher.generate(cleartext)
+    except HashingBusy:
+        return
+    # Works for the detached User built by the raw SQL login lookup too
+    User.query.filter_by(user_id=user.user_id).update({'password_hash': new_hash})
+    db.session.commit()
+    user.password_hash = new_hash
+
+
+# Streams the export from a generator, stream_with_context keeps the
+# request and its database session alive until the last row is sent
+def export_response(fmt, filename, class_id):
+    # Like the roster import, only imported once an export is asked for
+    import exports
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    to_chunks, mimetype = exports.FORMATS[fmt]
+    rows = exports.attendance_rows(class_id, batch_size)
+    return Response(stream_with_context(to_chunks(rows, batch_size)), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename={0}.{1}'.format(filename, fmt)
+    })
+
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-lines')
+
+
+# Records of a batch check-in. NDJSON is read line by line and stops once
+# there are more than limit records, which check_in_batch() then refuses.
+def batch_records(limit):
+    if request.mimetype in NDJSON_MIMETYPES:
+        records = []
+        lines = enumerate(io.TextIOWrapper(request.stream, encoding='utf-8'), start=1)
+        while len(records) <= limit:
+            try:
+                number, line = next(lines, (None, None))
+            except UnicodeDecodeError:
+                raise ValueError('Body is not valid UTF-8')
+            if line is None:
+                break
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                raise ValueError('Line {0} is not valid JSON'.format(number))
+        return records
+
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('records')
+    if not isinstance(body, list):
+        raise ValueError('Expected a JSON array of records or NDJSON')
+    return body
+
+
+# Starts a job for the current user, 202 pointing at its status
+def job_response(kind, **params):
+    try:
+        job = jobs.submit(kind, owner_id=current_user.user_id, **params)
+    except JobsBusy:
+        return jsonify({'error': 'Too many jobs running, please try again later'}), 503, {'Retry-After': '5'}
+    return jsonify(describe(job)), 202, {'Location': url_for('auth.job_status', id=job.job_id)}
+
+
+# At-risk attendance rate of a report, AT_RISK_THRESHOLD unless asked otherwise
+def report_threshold():
+    return request.values.get('threshold', current_app.config['AT_RISK_THRESHOLD'], type=float)
+
+
+# Returns the class_id an enrollment code belongs to, or None for an unknown
+# code. Answered from the unique index on enrollment_code, see codes.py.
 def validate_registration(code):
-    valid_class = Classes.query.filter_by(enrollment_code=code).first()
-    if not valid_class:
-        return None
+    return class_id_for_enrollment_code(code)
@@ -0,0 +1,126 @@
+"""Storage size and report latency before and after attendance compaction.
+
+Seeds a SQLite stand-in with --terms closed terms of synthetic attendance,
+measures the database file size and the latency of the class report and the
+archive-aware duplicate check, runs archive.compact() and measures again.
+
+    python benchmarks/bench_archive.py --students 500 --classes 10 --terms 4
+"""
+import argparse
+import datetime
+import os
+import random
+import time
+
+from common import app, db, use_sqlite
+from models import User, Classes, Enrollment, Attendance
+import archive
+import reports
+
+SESSIONS_PER_TERM = 40
+
+
+def seed(classes, students, terms, rate):
+    rng = random.Random(1)
+    # Closed terms only, the last one ending before today's term started
+    with app.app_context():
+        start = archive.open_term_start()
+        term_days = []
+        for i in range(terms):
+            start = archive.term_of(start - datetime.timedelta(days=1))[1]
+            term_days.append([start + datetime.timedelta(days=2 * day) for day in range(SESSIONS_PER_TERM)])
+
+        teacher = User(name='Teacher', email='teacher@example.com', user_type='teacher', password_hash='!')
+        db.session.add(teacher)
+        db.session.commit()
+        db.session.execute(User.__table__.insert(), [
+            {'name': 'Student {0}'.format(i), 'email': 's{0}@example.com'.format(i),
+             'password_hash': '!{0}'.format(i), 'user_type': 'student', 'session_version': 0}
+            for i in range(students)])
+        db.session.execute(Classes.__table__.insert(), [
+            {'name': 'Class {0}'.format(i), 'section': '1', 'enrollment_code': 'code{0}'.format(i),
+             'professor_id': teacher.user_id}
+            for i in range(classes)])
+        db.session.commit()
+        user_ids = [row.user_id for row in db.session.query(User.user_id).filter_by(user_type='student')]
+        class_ids = [row.class_id for row in db.session.query(Classes.class_id)]
+        db.session.execute(Enrollment.__table__.insert(), [
+            {'class_id': class_id, 'user_id': user_id, 'dropped': False}
+            for class_id in class_ids for user_id in user_ids])
+
+        rows = 0
+        for days in term_days:
+            batch = [{'class_id': class_id, 'user_id': user_id, 'date': date}
+                     for class_id in class_ids for user_id in user_ids for date in days
+                     if rng.random() < rate]
+            db.session.execute(Attendance.__table__.insert(), batch)
+            db.session.commit()
+            rows += len(batch)
+        return class_ids, user_ids, term_days[-1][0], rows
+
+
+def file_size(path):
+    with app.app_context():
+        db.session.execute('VACUUM')
+        db.session.commit()
+    return os.path.getsize(path)
+
+
+def measure(class_ids, user_ids, date, repeat):
+    with app.app_context():
+        start = time.perf_counter()
+        for i in range(repeat):
+            reports.class_attendance_report(class_ids[i % len(class_ids)])
+        report = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            class_id = class_ids[i % len(class_ids)]
+            user_id = user_ids[i % len(user_ids)]
+            (db.session.query(Attendance.date)
+             .filter_by(class_id=class_id, user_id=user_id, date=date).first() is not None
+             or archive.is_archived(class_id, user_id, date))
+        duplicate = (time.perf_counter() - start) / repeat
+        db.session.remove()
+    return report, duplicate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--students', type=int, default=500)
+    parser.add_argument('--terms', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0.8, help='Chance a student attends a session')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    path = use_sqlite()
+    try:
+        class_ids, user_ids, date, rows = seed(args.classes, args.students, args.terms, args.rate)
+        before_size = file_size(path)
+        before = measure(class_ids, user_ids, date, args.repeat)
+        with app.app_context():
+            before_report = reports.class_attendance_report(class_ids[0])
+
+            start = time.perf_counter()
+            summary = archive.compact()
+            elapsed = time.perf_counter() - start
+            archived = db.session.query(db.func.count()).select_from(archive.AttendanceArchive).scalar()
+            after_report = reports.class_attendance_report(class_ids[0])
+        after_size = file_size(path)
+        after = measure(class_ids, user_ids, date, args.repeat)
+
+        print('compacted {0} rows into {1} archive rows in {2:.1f} s'.format(summary['rows'], archived, elapsed))
+        print('{0:<28}{1:>12}{2:>12}'.format('', 'before', 'after'))
+        print('{0:<28}{1:>12.1f}{2:>12.1f}'.format('database size (MB)', before_size / 2.0 ** 20, after_size / 2.0 ** 20))
+        print('{0:<28}{1:>12.2f}{2:>12.2f}'.format('class report (ms)', before[0] * 1000, after[0] * 1000))
+        print('{0:<28}{1:>12.3f}{2:>12.3f}'.format('duplicate check (ms)', before[1] * 1000, after[1] * 1000))
+        if summary['rows'] != rows or before_report != after_report:
+            print('report changed after compaction')
+            raise SystemExit(1)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
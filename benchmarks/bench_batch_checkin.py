@@ -0,0 +1,84 @@
+"""One batch check-in against a check-in request per student.
+
+Enrolls the same students in two classes of a SQLite stand-in. In the
+first one every student checks in with their own GET /mark_attendance;
+the second one is synced by the teacher with a single POST
+/attendance/batch of the same number of records, then synced again to
+show the batch is idempotent. Reports time and SQL statements of each.
+
+    python benchmarks/bench_batch_checkin.py --students 2000
+"""
+import argparse
+import datetime
+import os
+import time
+
+from common import app, db, logged_in_client, use_sqlite
+from metrics import metrics
+from models import User, Classes, Enrollment
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'benchmark-password'
+# Cheap hashes, the logins are not what is measured here
+HASH_METHOD = 'pbkdf2:sha256:1'
+
+
+def seed(students):
+    with app.app_context():
+        teacher = User(name='Teacher', email='teacher@example.com', user_type='teacher',
+                       password_hash=generate_password_hash(PASSWORD, HASH_METHOD))
+        db.session.add(teacher)
+        db.session.commit()
+        db.session.execute(User.__table__.insert(), [
+            {'name': 'Student {0}'.format(i), 'email': 'student{0}@example.com'.format(i),
+             'password_hash': generate_password_hash(PASSWORD, HASH_METHOD), 'user_type': 'student'}
+            for i in range(students)])
+        classes = [Classes(name='Per request', section='1', enrollment_code='per-request',
+                           professor_id=teacher.user_id),
+                   Classes(name='Batch', section='1', enrollment_code='batch', professor_id=teacher.user_id)]
+        db.session.add_all(classes)
+        db.session.commit()
+        user_ids = [row[0] for row in db.session.query(User.user_id).filter_by(user_type='student')]
+        db.session.execute(Enrollment.__table__.insert(), [
+            {'class_id': course.class_id, 'user_id': user_id, 'dropped': False}
+            for course in classes for user_id in user_ids])
+        db.session.commit()
+        return [course.class_id for course in classes], user_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=2000)
+    args = parser.parse_args()
+
+    path = use_sqlite()
+    # Admission control would pace the per-request check-ins, and logins
+    # would upgrade the cheap hashes
+    app.config.update(CHECKIN_CLASS_RATE=0, CHECKIN_GLOBAL_RATE=0, PASSWORD_HASH_METHOD=HASH_METHOD,
+                      ATTENDANCE_BATCH_MAX=max(args.students, app.config['ATTENDANCE_BATCH_MAX']))
+    try:
+        (per_request_class, batch_class), user_ids = seed(args.students)
+        clients = [logged_in_client('student{0}@example.com'.format(i), PASSWORD) for i in range(args.students)]
+
+        start = time.perf_counter()
+        with metrics.query_budget(10 ** 9) as statements:
+            failed = sum(1 for client in clients
+                         if not client.get('/mark_attendance/{0}'.format(per_request_class)).json['success'])
+        print('{0:<22} {1:>5} requests {2:>8.3f} s {3:>6} statements  failed {4}'.format(
+            'per-student GETs', len(clients), time.perf_counter() - start, len(statements), failed))
+
+        teacher = logged_in_client('teacher@example.com', PASSWORD)
+        today = datetime.date.today().isoformat()
+        records = [{'class_id': batch_class, 'user_id': user_id, 'date': today} for user_id in user_ids]
+        for label in ('batch POST', 'batch POST again'):
+            start = time.perf_counter()
+            with metrics.query_budget(10 ** 9) as statements:
+                response = teacher.post('/attendance/batch', json=records)
+            print('{0:<22} {1:>5} requests {2:>8.3f} s {3:>6} statements  {4}'.format(
+                label, 1, time.perf_counter() - start, len(statements), response.json['counts']))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
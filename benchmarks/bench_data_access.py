@@ -0,0 +1,106 @@
+"""Compares ORM and raw SQL (database.Database) throughput for the hot paths.
+
+Runs against the MySQL database configured through the usual MYSQL_*
+environment variables. A throwaway teacher, class and set of students are
+created first and removed again at the end.
+
+    python benchmarks/bench_data_access.py --students 500 --repeat 2000
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app, db, mysql_db
+from models import User, Enrollment, Attendance
+
+
+def timed(label, repeat, fn):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print('{0:<32} {1:>10.0f} ops/s  {2:>8.3f} ms/op'.format(
+        label, repeat / elapsed, 1000.0 * elapsed / repeat))
+
+
+def seed(students):
+    stamp = int(time.time())
+    teacher_email = 'bench-teacher-{0}@example.com'.format(stamp)
+    mysql_db.execute(
+        'INSERT INTO Users (name, email, password_hash, user_type) VALUES (%s, %s, %s, %s)',
+        ('Bench Teacher', teacher_email, 'bench-{0}'.format(stamp), 'teacher'))
+    teacher_id = mysql_db.fetchone('SELECT user_id FROM Users WHERE email=%s', (teacher_email,))['user_id']
+    mysql_db.execute(
+        'INSERT INTO Classes (name, section, enrollment_code, professor_id) VALUES (%s, %s, %s, %s)',
+        ('Bench', '1', 'bench-{0}'.format(stamp), teacher_id))
+    class_id = mysql_db.fetchone('SELECT class_id FROM Classes WHERE enrollment_code=%s',
+                                 ('bench-{0}'.format(stamp),))['class_id']
+
+    emails = ['bench-{0}-{1}@example.com'.format(stamp, i) for i in range(students)]
+    mysql_db.executemany(
+        'INSERT INTO Users (name, email, password_hash, user_type) VALUES (%s, %s, %s, %s)',
+        [('Bench Student {0}'.format(i), email, 'bench-{0}-{1}'.format(stamp, i), 'student')
+         for i, email in enumerate(emails)])
+    student_ids = [row['user_id'] for row in mysql_db.fetchall(
+        'SELECT user_id FROM Users WHERE email LIKE %s ORDER BY user_id', ('bench-{0}-%'.format(stamp),))]
+    mysql_db.executemany('INSERT INTO Enrollment (class_id, user_id, dropped) VALUES (%s, %s, 0)',
+                         [(class_id, user_id) for user_id in student_ids])
+    return teacher_id, class_id, student_ids, emails
+
+
+def cleanup(teacher_id, student_ids):
+    # Classes, Enrollment and Attendance go with the teacher through ON DELETE CASCADE
+    mysql_db.execute('DELETE FROM Users WHERE user_id=%s', (teacher_id,))
+    mysql_db.executemany('DELETE FROM Users WHERE user_id=%s', [(user_id,) for user_id in student_ids])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        teacher_id, class_id, student_ids, emails = seed(args.students)
+        count = len(student_ids)
+        try:
+            print('Login lookup by email')
+            timed('  ORM  User.query.filter_by', args.repeat,
+                  lambda i: User.query.filter_by(email=emails[i % count]).first())
+            timed('  raw  get_existing_user', args.repeat,
+                  lambda i: mysql_db.get_existing_user(emails[i % count]))
+
+            print('Enrollment lookup')
+            timed('  ORM  Enrollment.query', args.repeat,
+                  lambda i: Enrollment.query.filter_by(
+                      class_id=class_id, user_id=student_ids[i % count], dropped=False).all())
+            timed('  raw  is_enrolled', args.repeat,
+                  lambda i: mysql_db.is_enrolled(class_id, student_ids[i % count]))
+
+            # Each op checks in one student on a distinct date
+            day = datetime.date(2000, 1, 1)
+            print('Check-in')
+
+            def orm_checkin(i):
+                date = day + datetime.timedelta(days=i // count)
+                if not Attendance.query.filter_by(class_id=class_id, user_id=student_ids[i % count],
+                                                  date=date).all():
+                    db.session.add(Attendance(class_id=class_id, user_id=student_ids[i % count], date=date))
+                    db.session.commit()
+            timed('  ORM  query + add + commit', args.repeat, orm_checkin)
+
+            raw_day = datetime.date(2010, 1, 1)
+            timed('  raw  insert_attendance', args.repeat,
+                  lambda i: mysql_db.insert_attendance(
+                      [(class_id, student_ids[i % count], raw_day + datetime.timedelta(days=i // count))]))
+        finally:
+            db.session.rollback()
+            cleanup(teacher_id, student_ids)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Streams an export of 1M synthetic attendance rows under a memory ceiling.
+
+Seeds a SQLite stand-in, downloads the admin-wide export through the app
+without buffering the response, and fails if the Python heap peak during
+the download goes over --max-memory-mb.
+
+    python benchmarks/bench_export.py --rows 1000000 --format csv --max-memory-mb 32
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+
+from common import app, db, logged_in_client, use_sqlite
+from models import User, Classes, Attendance
+from werkzeug.security import generate_password_hash
+
+CLASSES = 10
+STUDENTS = 500
+
+
+def seed(rows):
+    dates_needed = -(-rows // (CLASSES * STUDENTS))
+    first_day = datetime.date(2000, 1, 1)
+    with app.app_context():
+        admin = User(name='Admin', email='admin@example.com', user_type='teacher',
+                     password_hash=generate_password_hash('benchmark-password'))
+        db.session.add(admin)
+        db.session.commit()
+        db.session.execute(User.__table__.insert(), [
+            {'name': 'Student {0}'.format(i), 'email': 's{0}@example.com'.format(i),
+             'password_hash': '!{0}'.format(i), 'user_type': 'student', 'session_version': 0}
+            for i in range(STUDENTS)])
+        db.session.execute(Classes.__table__.insert(), [
+            {'name': 'Class {0}'.format(i), 'section': '1', 'enrollment_code': 'code{0}'.format(i),
+             'professor_id': admin.user_id}
+            for i in range(CLASSES)])
+        db.session.commit()
+        user_ids = [row.user_id for row in db.session.query(User.user_id).filter_by(user_type='student')]
+        class_ids = [row.class_id for row in db.session.query(Classes.class_id)]
+
+        batch, written = [], 0
+        for day in range(dates_needed):
+            date = first_day + datetime.timedelta(days=day)
+            for class_id in class_ids:
+                for user_id in user_ids:
+                    if written == rows:
+                        break
+                    batch.append({'class_id': class_id, 'user_id': user_id, 'date': date})
+                    written += 1
+            if len(batch) >= 50000 or written == rows:
+                db.session.execute(Attendance.__table__.insert(), batch)
+                db.session.commit()
+                batch = []
+        return admin.user_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    parser.add_argument('--max-memory-mb', type=float, default=32)
+    args = parser.parse_args()
+
+    path = use_sqlite()
+    try:
+        start = time.perf_counter()
+        admin_id = seed(args.rows)
+        print('seeded {0} rows in {1:.1f} s'.format(args.rows, time.perf_counter() - start))
+        app.config['ADMIN_USER_IDS'] = [admin_id]
+        client = logged_in_client('admin@example.com', 'benchmark-password')
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = client.get('/admin/export.' + args.format, buffered=False)
+        size = lines = 0
+        for chunk in response.response:
+            size += len(chunk)
+            lines += chunk.count(b'\n') if isinstance(chunk, bytes) else chunk.count('\n')
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        response.close()
+
+        peak_mb = peak / 2.0 ** 20
+        print('exported {0} lines, {1:.1f} MB in {2:.1f} s, peak memory {3:.1f} MB'.format(
+            lines, size / 2.0 ** 20, elapsed, peak_mb))
+        expected = args.rows + (1 if args.format == 'csv' else 0)
+        if lines != expected:
+            print('expected {0} lines'.format(expected))
+            sys.exit(1)
+        if peak_mb > args.max_memory_mb:
+            print('memory ceiling of {0} MB exceeded'.format(args.max_memory_mb))
+            sys.exit(1)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Login throughput at different password hashing pool sizes.
+
+Fires concurrent logins at the in-process app backed by a SQLite stand-in
+and reports logins per second, p50/p99 latency and how many were shed with
+503 because the hashing queue was full.
+
+    python benchmarks/bench_login.py --pool-sizes 0,1,2,4 --logins 200 --concurrency 16
+"""
+import argparse
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+from common import app, db, use_sqlite
+from hashing import password_hasher
+from models import User
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'benchmark-password'
+
+
+def seed(users, method):
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {'name': 'Student {0}'.format(i), 'email': 'student{0}@example.com'.format(i),
+             # password_hash is unique, every user gets its own salt
+             'password_hash': generate_password_hash(PASSWORD, method), 'user_type': 'student'}
+            for i in range(users)])
+        db.session.commit()
+
+
+def run(pool_size, logins, concurrency, users):
+    password_hasher.shutdown()
+    app.config['HASH_POOL_SIZE'] = pool_size
+    latencies, outcomes = [], []
+    lock = threading.Lock()
+    counter = iter(range(logins))
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            response = client.post('/login', data={
+                'email': 'student{0}@example.com'.format(i % users), 'password': PASSWORD})
+            elapsed = time.perf_counter() - start
+            client.get('/logout')
+            with lock:
+                latencies.append(elapsed)
+                outcomes.append(outcome(response))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    print('pool {0:>2}: {1:>7.1f} logins/s  p50 {2:>7.1f} ms  p99 {3:>7.1f} ms  shed {4}  failed {5}'.format(
+        pool_size, len(latencies) / wall,
+        1000 * latencies[len(latencies) // 2],
+        1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        outcomes.count('shed'), outcomes.count('failed')))
+
+
+# A wrong password redirects back to /login, only other redirects are logins
+def outcome(response):
+    if response.status_code == 503:
+        return 'shed'
+    if response.status_code == 302 and urlparse(response.headers['Location']).path != '/login':
+        return 'ok'
+    return 'failed'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pool-sizes', default='0,1,2,4')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    path = use_sqlite()
+    try:
+        # Stored hashes use the configured method so no login triggers a rehash
+        seed(args.users, app.config['PASSWORD_HASH_METHOD'])
+        for pool_size in [int(size) for size in args.pool_sizes.split(',')]:
+            run(pool_size, args.logins, args.concurrency, args.users)
+    finally:
+        password_hasher.shutdown()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
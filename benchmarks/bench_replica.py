@@ -0,0 +1,135 @@
+"""Read/write routing against two SQLite files standing in for primary and replica.
+
+The replica starts as a copy of the primary and never receives the writes
+made afterwards, like a replica that stopped replicating, which makes it
+visible where each read was served from. Checks that:
+
+  - dashboard reads go to the replica
+  - a student who just enrolled reads their own write from the primary
+  - reads fall back to the primary when the replica lags or is down,
+    including when it fails in the middle of a request
+
+and reports dashboard latency on each database.
+
+    python benchmarks/bench_replica.py --repeat 200
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from common import app, db, logged_in_client, use_sqlite
+from models import User, Classes
+from routing import replica_router
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'benchmark-password'
+
+
+def seed():
+    with app.app_context():
+        teacher = User(name='Teacher', email='teacher@example.com', user_type='teacher',
+                       password_hash=generate_password_hash(PASSWORD))
+        student = User(name='Student', email='student@example.com', user_type='student',
+                       password_hash=generate_password_hash(PASSWORD))
+        db.session.add_all([teacher, student])
+        db.session.commit()
+        db.session.add(Classes(name='Replicated', section='1', enrollment_code='replicated',
+                               professor_id=teacher.user_id))
+        db.session.add(Classes(name='Primary only', section='1', enrollment_code='primary-only',
+                               professor_id=teacher.user_id))
+        db.session.commit()
+
+
+def use_replica(uri, **config):
+    app.config['SQLALCHEMY_BINDS'] = {'replica': uri}
+    app.config.update(config)
+    # Forget the last health check
+    replica_router.mark_down()
+    replica_router._checked = 0.0
+
+
+def timed(client, path, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        client.get(path)
+    return 1000.0 * (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    primary = use_sqlite()
+    handle, replica = tempfile.mkstemp(prefix='attendance-replica-', suffix='.db')
+    os.close(handle)
+    failures = []
+
+    def check(label, passed):
+        print('{0:<60} {1}'.format(label, 'ok' if passed else 'FAILED'))
+        if not passed:
+            failures.append(label)
+
+    try:
+        seed()
+        # Snapshot of the primary, then enable the replica; later writes only
+        # reach the primary
+        with app.app_context():
+            db.session.remove()
+            db.get_engine(app).dispose()
+        shutil.copyfile(primary, replica)
+        use_replica('sqlite:///' + replica, REPLICA_CHECK_INTERVAL=60, REPLICA_LAG_QUERY=None,
+                    READ_YOUR_WRITES_SECONDS=1)
+
+        student = logged_in_client('student@example.com', PASSWORD)
+        time.sleep(1.1)
+        replica_ms = timed(student, '/student_dashboard', args.repeat)
+        reads = replica_router.reads_replica
+        check('dashboard reads go to the replica', reads > 0)
+
+        response = student.post('/student_dashboard', data={'enrollment_code': 'primary-only'})
+        check('enrollment is written to the primary', response.status_code == 302)
+        page = student.get('/student_dashboard').get_data(as_text=True)
+        check('right after enrolling the dashboard shows the new class', 'Primary only' in page)
+        time.sleep(1.1)
+        page = student.get('/student_dashboard').get_data(as_text=True)
+        check('once stickiness expires reads go back to the (stale) replica', 'Primary only' not in page)
+
+        use_replica('sqlite:///' + replica, REPLICA_CHECK_INTERVAL=60, REPLICA_LAG_QUERY='SELECT 30',
+                    REPLICA_MAX_LAG=5)
+        page = student.get('/student_dashboard').get_data(as_text=True)
+        check('a lagging replica is skipped', 'Primary only' in page)
+        primary_ms = timed(student, '/student_dashboard', args.repeat)
+
+        use_replica('sqlite:////nonexistent/attendance/replica.db', REPLICA_CHECK_INTERVAL=60,
+                    REPLICA_LAG_QUERY=None)
+        page = student.get('/student_dashboard').get_data(as_text=True)
+        check('an unreachable replica is skipped', 'Primary only' in page)
+
+        # Healthy at the last check, then broken: an empty database without tables
+        use_replica('sqlite:///' + replica, REPLICA_CHECK_INTERVAL=60)
+        replica_router._healthy = True
+        replica_router._checked = time.time()
+        os.remove(replica)
+        fallbacks = replica_router.fallbacks
+        response = student.get('/student_dashboard')
+        check('a replica failing mid-request falls back to the primary',
+              response.status_code == 200 and replica_router.fallbacks == fallbacks + 1)
+        check('and is marked down', not replica_router.healthy())
+
+        print('student_dashboard: {0:.2f} ms/request on the replica, {1:.2f} ms on the primary'.format(
+            replica_ms, primary_ms))
+    finally:
+        for path in (primary, replica):
+            if os.path.exists(path):
+                os.remove(path)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Imports a synthetic roster of 10k students into a SQLite stand-in.
+
+Times a first import (creates every user and enrollment) and a re-run of
+the same roster (must change nothing), and counts the SQL statements run.
+
+    python benchmarks/bench_roster_import.py --students 10000 --chunk-size 1000
+"""
+import argparse
+import io
+import os
+import time
+
+from common import app, db, use_sqlite
+from metrics import metrics
+from models import User, Classes
+from roster import import_roster
+
+
+def roster_csv(students):
+    lines = ['name,email']
+    lines.extend('Student {0},student{0}@example.com'.format(i) for i in range(students))
+    return '\n'.join(lines) + '\n'
+
+
+def timed_import(class_id, csv_text):
+    start = time.perf_counter()
+    with metrics.query_budget(10 ** 9) as statements:
+        summary = import_roster(class_id, io.StringIO(csv_text))
+    return time.perf_counter() - start, len(statements), summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=10000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    path = use_sqlite()
+    app.config['ROSTER_CHUNK_SIZE'] = args.chunk_size
+    try:
+        with app.app_context():
+            teacher = User(name='Teacher', email='teacher@example.com', password_hash='!teacher',
+                           user_type='teacher')
+            db.session.add(teacher)
+            db.session.commit()
+            course = Classes(name='Bench', section='1', enrollment_code='bench', professor_id=teacher.user_id)
+            db.session.add(course)
+            db.session.commit()
+
+            csv_text = roster_csv(args.students)
+            for label in ('first import', 're-run'):
+                elapsed, statements, summary = timed_import(course.class_id, csv_text)
+                print('{0:<13} {1:>7.2f} s  {2:>8.0f} rows/s  {3:>4} statements  '
+                      'created {4}  enrolled {5}  errors {6}'.format(
+                          label, elapsed, args.students / elapsed, statements,
+                          summary['created_users'], summary['enrolled'], len(summary['errors'])))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
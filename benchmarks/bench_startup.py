@@ -0,0 +1,84 @@
+"""Measures cold-start cost: import time of app.py and time to first response.
+
+Every run happens in a fresh interpreter, like a new Lambda container. The
+first response is served from a page that needs no database, so the numbers
+cover imports, app setup and the first template render only.
+
+    python benchmarks/bench_startup.py --runs 10 --max-import-ms 400
+
+--root points it at another checkout, e.g. a worktree of an older commit
+to compare against:
+
+    git worktree add /tmp/before <commit>
+    python benchmarks/bench_startup.py --root /tmp/before
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs inside the child interpreter
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get({url!r})
+responded = time.perf_counter()
+print(json.dumps({{
+    'import_ms': 1000 * (imported - start),
+    'first_response_ms': 1000 * (responded - start),
+    'status': response.status_code,
+}}))
+'''
+
+
+def run_once(url, root=ROOT):
+    env = dict(os.environ)
+    env.setdefault('SECRET_KEY', 'bench')
+    output = subprocess.check_output([sys.executable, '-c', PROBE.format(url=url)], cwd=root, env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--url', default='/about')
+    parser.add_argument('--root', default=ROOT, help='checkout to measure, defaults to this one')
+    parser.add_argument('--max-import-ms', type=float,
+                        help='exit non-zero when the median import time is above this')
+    parser.add_argument('--max-first-response-ms', type=float,
+                        help='exit non-zero when the median time to first response is above this')
+    args = parser.parse_args()
+
+    runs = [run_once(args.url, args.root) for i in range(args.runs)]
+    result = {
+        'runs': args.runs,
+        'url': args.url,
+        'import_ms': median([run['import_ms'] for run in runs]),
+        'first_response_ms': median([run['first_response_ms'] for run in runs]),
+        'statuses': sorted(set(run['status'] for run in runs)),
+    }
+    print(json.dumps(result, indent=2))
+
+    failed = False
+    if args.max_import_ms is not None and result['import_ms'] > args.max_import_ms:
+        print('import time regression: {0:.1f} ms > {1} ms'.format(result['import_ms'], args.max_import_ms))
+        failed = True
+    if args.max_first_response_ms is not None and result['first_response_ms'] > args.max_first_response_ms:
+        print('first response regression: {0:.1f} ms > {1} ms'.format(
+            result['first_response_ms'], args.max_first_response_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
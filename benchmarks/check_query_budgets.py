@@ -0,0 +1,107 @@
+"""Checks the dashboards and the class page stay within their query budgets.
+
+Renders each page under metrics.query_budget() against a SQLite stand-in,
+once cold and once more with the page caches warm, and fails if a render
+runs more queries than allowed. The budgets do not depend on the number of
+classes or students, run it with larger --students and --classes to check
+nothing went back to one query per row. Exits with status 1 on a failure.
+
+    python benchmarks/check_query_budgets.py --students 200 --classes 10
+"""
+import argparse
+import datetime
+import os
+import sys
+
+from common import app, db, logged_in_client, use_sqlite
+from metrics import metrics
+from models import User, Classes, Enrollment, Attendance
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'benchmark-password'
+# Cheap hashes, the logins are not what is checked here
+HASH_METHOD = 'pbkdf2:sha256:1'
+
+# (label, role, path, cold budget, warm budget). A dashboard is the user's
+# content_version and the class list, the class page is the class and the
+# attendance report (plus one query for archived terms).
+BUDGETS = [
+    ('student dashboard', 'student', '/student_dashboard', 2, 1),
+    ('teacher dashboard', 'teacher', '/teacher_dashboard', 2, 1),
+    ('teacher class page', 'teacher', '/teacher_class_page/{class_id}', 3, 1),
+]
+
+
+def seed(students, classes, days):
+    with app.app_context():
+        teacher = User(name='Teacher', email='teacher@example.com', user_type='teacher',
+                       password_hash=generate_password_hash(PASSWORD, HASH_METHOD))
+        db.session.add(teacher)
+        db.session.commit()
+        db.session.execute(User.__table__.insert(), [
+            {'name': 'Student {0}'.format(i), 'email': 'student{0}@example.com'.format(i),
+             'password_hash': generate_password_hash(PASSWORD, HASH_METHOD), 'user_type': 'student'}
+            for i in range(students)])
+        db.session.execute(Classes.__table__.insert(), [
+            {'name': 'Class {0}'.format(i), 'section': '1', 'enrollment_code': 'code-{0}'.format(i),
+             'professor_id': teacher.user_id}
+            for i in range(classes)])
+        db.session.commit()
+        user_ids = [row[0] for row in db.session.query(User.user_id).filter_by(user_type='student')]
+        class_ids = [row[0] for row in db.session.query(Classes.class_id)]
+        db.session.execute(Enrollment.__table__.insert(), [
+            {'class_id': class_id, 'user_id': user_id, 'dropped': False}
+            for class_id in class_ids for user_id in user_ids])
+        today = datetime.date.today()
+        db.session.execute(Attendance.__table__.insert(), [
+            {'class_id': class_ids[0], 'user_id': user_id, 'date': today - datetime.timedelta(days=day)}
+            for day in range(days) for user_id in user_ids[day % 2::2]])
+        db.session.commit()
+        return class_ids[0]
+
+
+# Number of queries of one GET, or the AssertionError of a blown budget
+def check(client, path, budget):
+    try:
+        with metrics.query_budget(budget) as statements:
+            response = client.get(path)
+    except AssertionError as error:
+        return len(statements), error
+    if response.status_code != 200:
+        return len(statements), AssertionError('{0} answered {1}'.format(path, response.status_code))
+    return len(statements), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--days', type=int, default=30)
+    args = parser.parse_args()
+
+    path = use_sqlite()
+    app.config.update(PASSWORD_HASH_METHOD=HASH_METHOD)
+    failures = []
+    try:
+        class_id = seed(args.students, args.classes, args.days)
+        clients = {'student': logged_in_client('student0@example.com', PASSWORD),
+                   'teacher': logged_in_client('teacher@example.com', PASSWORD)}
+
+        for label, role, route, cold, warm in BUDGETS:
+            route = route.format(class_id=class_id)
+            for state, budget in (('cold', cold), ('warm', warm)):
+                queries, error = check(clients[role], route, budget)
+                print('{0:<20} {1:<5} {2:>3} queries  budget {3:>3}  {4}'.format(
+                    label, state, queries, budget, 'FAIL' if error else 'ok'))
+                if error:
+                    failures.append(error)
+    finally:
+        os.remove(path)
+
+    for error in failures:
+        print('\n{0}'.format(error))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
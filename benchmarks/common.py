@@ -0,0 +1,37 @@
+"""Shared setup for the benchmarks: a throwaway SQLite stand-in database."""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SECRET_KEY', 'bench')
+
+from app import app, db
+
+
+# Points the app at a fresh SQLite file and creates the schema. Works because
+# the engine is only created on first use.
+def use_sqlite(path=None):
+    if path is None:
+        handle, path = tempfile.mkstemp(prefix='attendance-bench-', suffix='.db')
+        os.close(handle)
+    use_database('sqlite:///' + os.path.abspath(path))
+    return path
+
+
+# Same for any database URI, e.g. a scratch MySQL database. Its tables are
+# dropped and created again.
+def use_database(uri):
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+def logged_in_client(email, password):
+    client = app.test_client()
+    response = client.post('/login', data={'email': email, 'password': password})
+    if response.status_code != 302:
+        raise RuntimeError('Login failed for {0}: {1}'.format(email, response.status_code))
+    return client
@@ -0,0 +1,336 @@
+"""Lecture-start load test for logins, check-ins, class pages and dashboards.
+
+Seeds a synthetic dataset (teachers, classes, students, enrollments and
+--months of past attendance) and runs three scenarios against the app:
+
+  lecture_start      every student logs in and checks in, arrivals spread
+                     at random over --window seconds
+  teacher_class_page every teacher loads each of their class pages
+  student_dashboard  every student loads their dashboard
+
+For each route it reports throughput, p50/p99 latency measured by the
+client and SQL statements per request counted by metrics.py, and writes
+everything to a JSON file so runs on different commits can be compared.
+
+Requests go through the Flask test client, or over HTTP to a local
+threaded WSGI server with --wsgi. The database is a throwaway SQLite file
+unless --database-uri points at a scratch database, whose tables are
+dropped and created again.
+
+    python benchmarks/loadtest.py --students 300 --window 60 --concurrency 16
+    python benchmarks/loadtest.py --compare results/before.json results/after.json
+"""
+import argparse
+import datetime
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from common import app, db, use_database, use_sqlite
+from hashing import password_hasher
+from metrics import metrics
+from models import User, Classes, Enrollment, Attendance
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+PASSWORD = 'loadtest-password'
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    # Stored hashes use the method logins check against, so no login rehashes
+    method = app.config['PASSWORD_HASH_METHOD']
+
+    def user(i, kind):
+        return {'name': '{0} {1}'.format(kind.title(), i), 'email': '{0}{1}@example.com'.format(kind, i),
+                'password_hash': generate_password_hash(PASSWORD, method),
+                'user_type': kind, 'session_version': 0}
+
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [user(i, 'teacher') for i in range(args.teachers)])
+        db.session.execute(User.__table__.insert(), [user(i, 'student') for i in range(args.students)])
+        teacher_ids = [row[0] for row in db.session.query(User.user_id).filter_by(user_type='teacher')
+                       .order_by(User.user_id)]
+        student_ids = [row[0] for row in db.session.query(User.user_id).filter_by(user_type='student')
+                       .order_by(User.user_id)]
+
+        db.session.execute(Classes.__table__.insert(), [
+            {'name': 'Class {0}'.format(i), 'section': str(i % 3 + 1),
+             'enrollment_code': 'loadtest{0}'.format(i), 'professor_id': teacher_ids[i % len(teacher_ids)]}
+            for i in range(args.teachers * args.classes_per_teacher)])
+        class_ids = [row[0] for row in db.session.query(Classes.class_id).order_by(Classes.class_id)]
+
+        enrollments = dict((user_id, rng.sample(class_ids, min(args.classes_per_student, len(class_ids))))
+                           for user_id in student_ids)
+        db.session.execute(Enrollment.__table__.insert(), [
+            {'class_id': class_id, 'user_id': user_id, 'dropped': False}
+            for user_id, classes in enrollments.items() for class_id in classes])
+
+        # Two sessions a week per class, ending yesterday
+        today = datetime.date.today()
+        days = [today - datetime.timedelta(days=day) for day in range(1, args.months * 30 + 1)]
+        session_days = [day for day in days if day.weekday() in (1, 3)]
+        rows = [{'class_id': class_id, 'user_id': user_id, 'date': day}
+                for user_id, classes in enrollments.items() for class_id in classes
+                for day in session_days if rng.random() < args.attendance_rate]
+        for start in range(0, len(rows), 50000):
+            db.session.execute(Attendance.__table__.insert(), rows[start:start + 50000])
+        db.session.commit()
+    return teacher_ids, student_ids, enrollments, len(rows)
+
+
+# Test client of the in-process app, with the same interface as HttpClient
+class AppClient():
+    def __init__(self):
+        self.client = app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+# Cookie-keeping HTTP client for a server started by serve(), redirects not
+# followed so they can be counted like the test client's
+class HttpClient():
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirect())
+
+    def get(self, path):
+        return self._open(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, data):
+        return self._open(urllib.request.Request(
+            self.base_url + path, data=urllib.parse.urlencode(data).encode('ascii')))
+
+    def _open(self, request):
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+
+
+def serve():
+    # One access log line per request would drown the report
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_port)
+
+
+# Runs each task at its scheduled offset (seconds from the start) on
+# `concurrency` threads. A task is (offset, steps) with steps a list of
+# (route, fn) run one after the other, fn returning the status code and
+# route naming it in the report. Tasks that fall behind schedule start as
+# soon as a thread is free, like users who keep waiting.
+def run(tasks, concurrency):
+    tasks = sorted(tasks, key=lambda task: task[0])
+    samples = []
+    lock = threading.Lock()
+    position = iter(range(len(tasks)))
+    start = time.perf_counter()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(position, None)
+            if index is None:
+                return
+            offset, steps = tasks[index]
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            for route, fn in steps:
+                began = time.perf_counter()
+                status = fn()
+                elapsed = time.perf_counter() - began
+                with lock:
+                    samples.append((route, status, elapsed))
+
+    before = metrics.totals()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, time.perf_counter() - start, before, metrics.totals())
+
+
+def summarize(samples, wall, before, after):
+    routes = {}
+    for route in sorted(set(sample[0] for sample in samples)):
+        latencies = sorted(elapsed for name, status, elapsed in samples if name == route)
+        statuses = [status for name, status, elapsed in samples if name == route]
+        server = dict((name, value - before.get(route, {}).get(name, 0))
+                      for name, value in after.get(route, {}).items())
+        requests = server.get('requests', 0)
+        routes[route] = {
+            'requests': len(latencies),
+            'errors': sum(1 for status in statuses if status >= 400),
+            'statuses': dict((str(status), statuses.count(status)) for status in sorted(set(statuses))),
+            'throughput': round(len(latencies) / wall, 2),
+            'p50_ms': round(1000 * percentile(latencies, 0.5), 2),
+            'p99_ms': round(1000 * percentile(latencies, 0.99), 2),
+            'queries_per_request': round(server['queries'] / requests, 2) if requests else None,
+            'db_ms_per_request': round(1000 * server['db_seconds'] / requests, 2) if requests else None,
+        }
+    return {'seconds': round(wall, 2), 'routes': routes}
+
+
+# Nearest-rank percentile of a sorted list, same as metrics.py
+def percentile(samples, q):
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+def scenarios(args, teacher_ids, student_ids, enrollments, client_factory):
+    rng = random.Random(args.seed)
+    students = dict((user_id, client_factory()) for user_id in student_ids)
+    emails = dict((user_id, 'student{0}@example.com'.format(i)) for i, user_id in enumerate(student_ids))
+    results = {}
+
+    # Each student logs in and checks into their first class, at a random
+    # moment within the window
+    tasks = [(rng.uniform(0, args.window), [
+        ('auth.login', lambda client=client, email=emails[user_id]: client.post(
+            '/login', {'email': email, 'password': PASSWORD})),
+        ('auth.mark_attendance', lambda client=client, user_id=user_id: client.get(
+            '/mark_attendance/{0}'.format(enrollments[user_id][0])))])
+        for user_id, client in students.items()]
+    results['lecture_start'] = run(tasks, args.concurrency)
+
+    teachers = []
+    for i, user_id in enumerate(teacher_ids):
+        client = client_factory()
+        client.post('/login', {'email': 'teacher{0}@example.com'.format(i), 'password': PASSWORD})
+        teachers.append(client)
+    with app.app_context():
+        owned = [(teachers[teacher_ids.index(professor_id)], class_id) for class_id, professor_id
+                 in db.session.query(Classes.class_id, Classes.professor_id)]
+    tasks = [(0, [('auth.teacher_class_page', lambda client=client, class_id=class_id: client.get(
+        '/teacher_class_page/{0}'.format(class_id)))])
+        for repeat in range(args.page_loads) for client, class_id in owned]
+    results['teacher_class_page'] = run(tasks, args.concurrency)
+
+    tasks = [(0, [('auth.student_dashboard', lambda client=client: client.get('/student_dashboard'))])
+             for repeat in range(args.page_loads) for client in students.values()]
+    results['student_dashboard'] = run(tasks, args.concurrency)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print('{0} ({1}) -> {2} ({3})'.format(before_path, before['commit'], after_path, after['commit']))
+    for scenario, result in sorted(after['scenarios'].items()):
+        for route, stats in sorted(result['routes'].items()):
+            old = before['scenarios'].get(scenario, {}).get('routes', {}).get(route)
+            if old is None:
+                continue
+            print('{0:<20} {1:<26}'.format(scenario, route) + ''.join(
+                '  {0} {1} -> {2}'.format(key, old[key], stats[key])
+                for key in ('throughput', 'p50_ms', 'p99_ms', 'queries_per_request')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--teachers', type=int, default=5)
+    parser.add_argument('--classes-per-teacher', type=int, default=4)
+    parser.add_argument('--classes-per-student', type=int, default=3)
+    parser.add_argument('--months', type=int, default=4, help='Months of past attendance to seed')
+    parser.add_argument('--attendance-rate', type=float, default=0.85)
+    parser.add_argument('--window', type=float, default=60, help='Seconds over which students arrive')
+    parser.add_argument('--page-loads', type=int, default=3, help='Page loads per teacher class and per student')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--wsgi', action='store_true', help='Go through a local WSGI server instead of the test client')
+    parser.add_argument('--database-uri', help='Scratch database to use instead of a temporary SQLite file')
+    parser.add_argument('--output', help='Result file, defaults to results/loadtest-<commit>-<time>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    path = None
+    if args.database_uri:
+        use_database(args.database_uri)
+    else:
+        path = use_sqlite()
+    server = None
+    try:
+        start = time.perf_counter()
+        teacher_ids, student_ids, enrollments, attendance = seed(args)
+        print('seeded {0} students, {1} teachers, {2} attendance rows in {3:.1f} s'.format(
+            len(student_ids), len(teacher_ids), attendance, time.perf_counter() - start))
+
+        if args.wsgi:
+            server, base_url = serve()
+            client_factory = lambda: HttpClient(base_url)
+        else:
+            client_factory = AppClient
+        results = scenarios(args, teacher_ids, student_ids, enrollments, client_factory)
+    finally:
+        if server is not None:
+            server.shutdown()
+        password_hasher.shutdown()
+        if path is not None:
+            os.remove(path)
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': vars(args),
+        'scenarios': results,
+    }
+    for scenario, result in results.items():
+        for route, stats in sorted(result['routes'].items()):
+            print('{0:<20} {1:<26} {2:>5} req {3:>8.1f} req/s  p50 {4:>8.1f} ms  p99 {5:>8.1f} ms  '
+                  '{6} queries/req  {7} errors'.format(
+                      scenario, route, stats['requests'], stats['throughput'], stats['p50_ms'],
+                      stats['p99_ms'], stats['queries_per_request'], stats['errors']))
+
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, 'loadtest-{0}-{1}.json'.format(
+            commit or 'unknown', datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as result_file:
+        json.dump(report, result_file, indent=2, sort_keys=True)
+    print('results written to {0}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
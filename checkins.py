@@ -0,0 +1,137 @@
+from app import mysql_db
+from flask import current_app
+from models import db, insert_ignore, Attendance, AttendanceArchive, Classes, Enrollment
+from reports import attendance_counters
+import archive
+import datetime
+
+# Batch check-ins, for kiosks and scanners that record attendance offline
+# and sync later. A whole batch of (class_id, user_id, date) records costs a
+# fixed handful of queries however large it is: one joined query checks
+# every enrollment, one finds the check-ins already recorded (plus one on
+# the archive when the batch reaches into closed terms) and a single
+# INSERT IGNORE writes the rest, so syncing the same batch again changes
+# nothing.
+#
+# Every record gets one of the RESULTS codes, in the order it was sent.
+
+RESULTS = ('inserted', 'duplicate', 'not_enrolled', 'invalid')
+
+
+class BatchTooLarge(Exception):
+    pass
+
+
+# Returns ([code, ...], {code: count}) for the records, dicts with class_id,
+# user_id and an ISO date. Only classes taught by professor_id are accepted,
+# any class when it is None.
+def check_in_batch(records, professor_id=None):
+    if len(records) > current_app.config['ATTENDANCE_BATCH_MAX']:
+        raise BatchTooLarge('At most {0} records per batch'.format(current_app.config['ATTENDANCE_BATCH_MAX']))
+
+    today = datetime.date.today()
+    results = [None] * len(records)
+    keys = {}
+    for index, record in enumerate(records):
+        key = _parse(record, today)
+        if key is None:
+            results[index] = 'invalid'
+        elif key in keys:
+            # Sent twice in the same batch
+            results[index] = 'duplicate'
+        else:
+            keys[key] = index
+
+    if keys:
+        class_ids = set(key[0] for key in keys)
+        user_ids = set(key[1] for key in keys)
+        enrolled = _enrolled(class_ids, user_ids, professor_id)
+        existing = _existing(keys, class_ids, user_ids)
+        new_keys = []
+        for key, index in keys.items():
+            if (key[0], key[1]) not in enrolled:
+                results[index] = 'not_enrolled'
+            elif key in existing:
+                results[index] = 'duplicate'
+            else:
+                results[index] = 'inserted'
+                new_keys.append(key)
+        if new_keys:
+            _insert(new_keys)
+            for class_id in set(key[0] for key in new_keys):
+                attendance_counters.invalidate(class_id)
+
+    counts = dict((code, 0) for code in RESULTS)
+    for code in results:
+        counts[code] += 1
+    return results, counts
+
+
+# (class_id, user_id, date) of a well formed record dated no later than
+# today, None otherwise
+def _parse(record, today):
+    if not isinstance(record, dict):
+        return None
+    class_id, user_id, date = record.get('class_id'), record.get('user_id'), record.get('date')
+    if type(class_id) is not int or type(user_id) is not int or not isinstance(date, str):
+        return None
+    try:
+        date = datetime.date.fromisoformat(date)
+    except ValueError:
+        return None
+    if date > today:
+        return None
+    return class_id, user_id, date
+
+
+# {(class_id, user_id)} of the active enrollments among the pairs, in one
+# query over the cross product of the batch's classes and students
+def _enrolled(class_ids, user_ids, professor_id):
+    query = db.session.query(Enrollment.class_id, Enrollment.user_id) \
+        .filter(Enrollment.class_id.in_(class_ids), Enrollment.user_id.in_(user_ids),
+                Enrollment.dropped == False)
+    if professor_id is not None:
+        query = query.join(Classes, Classes.class_id == Enrollment.class_id) \
+            .filter(Classes.professor_id == professor_id)
+    return set((row[0], row[1]) for row in query)
+
+
+# The keys already recorded, live or archived
+def _existing(keys, class_ids, user_ids):
+    dates = set(key[2] for key in keys)
+    existing = set((row[0], row[1], row[2]) for row in db.session.query(
+        Attendance.class_id, Attendance.user_id, Attendance.date)
+        .filter(Attendance.class_id.in_(class_ids), Attendance.user_id.in_(user_ids),
+                Attendance.date.in_(dates)))
+
+    # Dates of closed terms may have been compacted already
+    cutoff = archive.open_term_start()
+    terms = dict((date, archive.term_of(date)) for date in dates if date < cutoff)
+    if terms:
+        bitmaps = dict(((row[0], row[1], row[2]), archive.decode(row[3])) for row in db.session.query(
+            AttendanceArchive.class_id, AttendanceArchive.user_id, AttendanceArchive.term,
+            AttendanceArchive.sessions)
+            .filter(AttendanceArchive.class_id.in_(class_ids), AttendanceArchive.user_id.in_(user_ids),
+                    AttendanceArchive.term.in_(set(term for term, start in terms.values()))))
+        for class_id, user_id, date in keys:
+            if date in terms:
+                term, start = terms[date]
+                if bitmaps.get((class_id, user_id, term), 0) >> (date - start).days & 1:
+                    existing.add((class_id, user_id, date))
+    return existing
+
+
+# One idempotent INSERT for all new check-ins, rows that arrived in the
+# meantime (a student checking in themselves) are skipped
+def _insert(keys):
+    if current_app.config['RAW_SQL_HOT_PATHS']:
+        mysql_db.insert_attendance(keys)
+        return
+
+    try:
+        db.session.execute(insert_ignore(Attendance.__table__), [
+            {'class_id': class_id, 'user_id': user_id, 'date': date} for class_id, user_id, date in keys])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
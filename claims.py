@@ -0,0 +1,89 @@
+from flask import current_app, url_for
+from hashlib import sha256
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from models import db, User
+
+# Claiming the student accounts a roster import creates (see roster.py).
+# Such an account has a placeholder password hash that matches no password.
+# Registering with its email does not hand it over: the address is emailed
+# a signed link instead, and only whoever opens that link may set the name
+# and password. The link carries a digest of the placeholder hash, which the
+# claim replaces, so it works once. It expires after CLAIM_TOKEN_MAX_AGE
+# seconds.
+#
+# Mail goes out over SMTP through MAIL_SERVER. Without one the message is
+# only written to the log, for development.
+
+
+# Accounts created by a roster import, waiting for the student to claim them
+def is_placeholder(user):
+    return user.user_type == 'student' and user.password_hash.startswith('!')
+
+
+def claim_token(user):
+    return _serializer().dumps({'user_id': user.user_id, 'hash': _digest(user.password_hash)})
+
+
+# The unclaimed User a token was made for, None if the token is forged,
+# expired or was used already
+def user_for_token(token):
+    try:
+        data = _serializer().loads(token, max_age=current_app.config['CLAIM_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return None
+    user = User.query.filter_by(user_id=data.get('user_id')).first()
+    if user is None or not is_placeholder(user) or _digest(user.password_hash) != data.get('hash'):
+        return None
+    return user
+
+
+# Sets the name and password, only while the placeholder hash the token was
+# made for is still there. Returns False when the account was claimed first.
+def claim(user, name, password_hash):
+    claimed = User.query.filter_by(user_id=user.user_id, password_hash=user.password_hash) \
+        .update({'name': name, 'password_hash': password_hash}, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+# Emails the claim link to the account's address. Raises OSError when the
+# mail server cannot be reached or refuses the message.
+def send_claim_link(user):
+    link = url_for('auth.claim_account', token=claim_token(user), _external=True)
+    days = current_app.config['CLAIM_TOKEN_MAX_AGE'] // (24 * 3600)
+    send_mail(user.email, 'Set up your attendance account',
+              'Your teacher added you to a class. Open this link to choose your password:\n\n'
+              '{0}\n\n'
+              'The link works once and expires in {1} days. If you did not try to register, '
+              'you can ignore this email.\n'.format(link, days))
+
+
+def send_mail(to, subject, body):
+    config = current_app.config
+    if not config['MAIL_SERVER']:
+        current_app.logger.warning('MAIL_SERVER is not set, not sending "%s" to %s:\n%s', subject, to, body)
+        return
+
+    # Only imported once mail is actually sent, not on every cold start
+    from email.message import EmailMessage
+    import smtplib
+    message = EmailMessage()
+    message['From'] = config['MAIL_SENDER']
+    message['To'] = to
+    message['Subject'] = subject
+    message.set_content(body)
+    with smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=config['MAIL_TIMEOUT']) as smtp:
+        if config['MAIL_USE_TLS']:
+            smtp.starttls()
+        if config['MAIL_USERNAME']:
+            smtp.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        smtp.send_message(message)
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='claim-account')
+
+
+# Tokens name the placeholder without revealing it
+def _digest(password_hash):
+    return sha256(password_hash.encode('utf-8')).hexdigest()[:16]
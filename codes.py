@@ -0,0 +1,42 @@
+from models import db, Classes
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+import secrets
+
+# Enrollment and attendance code generation and lookup.
+# Codes come from the `secrets` CSPRNG. Uniqueness is enforced by the unique
+# indexes on Classes.enrollment_code and Classes.attendance_code: a code is
+# written first and only regenerated if the insert hits a duplicate, instead
+# of checking for a duplicate and then inserting. Enrollment code lookups
+# go through the same index.
+
+
+class CodeCollision(Exception):
+    pass
+
+
+def generate_code(length=None, alphabet=None):
+    length = length or current_app.config['CODE_LENGTH']
+    alphabet = alphabet or current_app.config['CODE_ALPHABET']
+    return ''.join(secrets.choice(alphabet) for i in range(length))
+
+
+# Gives obj a fresh code in `attribute` and flushes it inside a savepoint,
+# retrying with a new code when the unique index reports a collision. The
+# caller still commits.
+def assign_unique_code(obj, attribute):
+    retries = current_app.config['CODE_RETRIES']
+    for attempt in range(retries):
+        code = generate_code()
+        setattr(obj, attribute, code)
+        try:
+            with db.session.begin_nested():
+                db.session.add(obj)
+            return code
+        except IntegrityError:
+            continue
+    raise CodeCollision('No unique {0} after {1} attempts'.format(attribute, retries))
+
+
+def class_id_for_enrollment_code(code):
+    return db.session.query(Classes.class_id).filter_by(enrollment_code=code).scalar()
@@ -1,16 +1,21 @@
-from flask import Blueprint, redirect, render_template
+from flask import Blueprint, redirect
 from os import environ
+from page_cache import page_cache
 
 # Blueprint that will be used to register new common routes for the app
 # common = does not need authentication can be accessed regardless of login
 common = Blueprint('common', __name__, template_folder='templates')
 
+# Rendered once per kind of visitor when the app starts, see page_cache.py
+page_cache.add_static('index', 'index.html', title='Home')
+page_cache.add_static('about', 'about.html', title='About')
+
 @common.route('/')
 @common.route('/home')
 @common.route('/index')
 def index():
-    return render_template('index.html', title='Home')
+    return page_cache.static_response('index')
 
 @common.route('/about')
 def about():
-    return render_template('about.html', title='About')
\ No newline at end of file
+    return page_cache.static_response('about')
\ No newline at end of file
@@ -1,58 +1,220 @@
+from contextlib import contextmanager
 from os import environ
-from pymysql import connect, cursors, Error
+import queue
+import threading
+import time
+
+# Database class that gives the hot paths raw SQL access without building
+# ORM objects. Everything else in the application goes through SQLAlchemy.
+#
+# Connections come from a bounded, thread-safe pool: a request checks one out,
+# runs its statements and hands it back. Connections are created on demand up
+# to maxsize, and a checkout that finds the pool exhausted waits up to timeout
+# seconds before raising PoolExhausted. Connections that sat idle longer than
+# ping_after seconds are pinged (and reconnected) before being handed out.
+#
+# PyMySQL itself is only imported when the first connection is opened, so a
+# cold start serving pages that never use raw SQL does not load it.
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+def _pymysql():
+    import pymysql.cursors
+    return pymysql
 
-# Database class that will be used to access the information for the application
-# Class is currently not in use database connectivity is handled using SQLAlchemy
 
 class Database():
-    def __init__(self):
-        host = environ.get('MYSQL_HOST')
-        user = environ.get('MYSQL_USER')
-        password = environ.get('MYSQL_PASSWORD')
-        db = environ.get('MYSQL_DB')
-
-        # initializes the connection for the database
-        self.db_con = connect(
-            host = host,
-            user = user,
-            password = password,
-            db = db,
-            cursorclass = cursors.DictCursor
+    def __init__(self, maxsize=10, timeout=5.0, ping_after=30.0):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.ping_after = ping_after
+
+        self._connect_args = dict(
+            host = environ.get('MYSQL_HOST'),
+            user = environ.get('MYSQL_USER'),
+            password = environ.get('MYSQL_PASSWORD'),
+            db = environ.get('MYSQL_DB'),
+            charset = 'utf8mb4',
+            # every statement is its own transaction, so a pooled connection
+            # never carries a stale read snapshot into its next checkout
+            autocommit = True
         )
 
-        # initializes the cursor for the database
-        # what runs queries
-        self.cursor = self.db_con.cursor()
+        # idle connections as (connection, returned_at), newest on top so the
+        # warm ones get reused and the rest can time out server side
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    # Checks a connection out of the pool for the duration of the block.
+    # Blocks that need a multi-statement transaction call begin() and
+    # commit() on it themselves, and are rolled back if they raise.
+    @contextmanager
+    def connection(self):
+        con = self._checkout()
+        done = False
+        try:
+            yield con
+            done = True
+        finally:
+            if done:
+                self._checkin(con)
+            else:
+                self._release_after_error(con)
+
+    @contextmanager
+    def cursor(self, server_side=False):
+        with self.connection() as con:
+            cursors = _pymysql().cursors
+            cursorclass = cursors.SSDictCursor if server_side else cursors.DictCursor
+            cursor = con.cursor(cursorclass)
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    # Runs a write, returns the affected row count
+    def execute(self, sql_query, args=None):
+        with self.cursor() as cursor:
+            return cursor.execute(sql_query, args)
+
+    # Runs one parameterized statement for every item of rows in a single
+    # round trip (PyMySQL folds INSERT ... VALUES into a multi-row insert)
+    def executemany(self, sql_query, rows):
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self.cursor() as cursor:
+            return cursor.executemany(sql_query, rows)
+
+    def fetchone(self, sql_query, args=None):
+        with self.cursor() as cursor:
+            cursor.execute(sql_query, args)
+            return cursor.fetchone()
+
+    def fetchall(self, sql_query, args=None):
+        with self.cursor() as cursor:
+            cursor.execute(sql_query, args)
+            return cursor.fetchall()
+
+    # Yields rows one at a time from a server-side cursor so result sets
+    # larger than memory can be walked. The connection stays checked out
+    # until the generator is exhausted or closed.
+    def stream(self, sql_query, args=None):
+        with self.cursor(server_side=True) as cursor:
+            cursor.execute(sql_query, args)
+            for row in cursor.fetchall_unbuffered():
+                yield row
 
     # Inserts user into [USER_TABLE] based on the schema given in the readme
     def create_user(self, user_name, user_email, user_password, user_type):
-        sql_query = 'INSERT INTO users (`name`, `email`, `password_hash`, `user_type`) VALUES (%s, %s, %s, %s)'
+        sql_query = 'INSERT INTO Users (`name`, `email`, `password_hash`, `user_type`) VALUES (%s, %s, %s, %s)'
 
-        try: 
-            self.cursor.execute(sql_query, (user_name, user_email, user_password, user_type))
-            self.db_con.commit()
+        try:
+            self.execute(sql_query, (user_name, user_email, user_password, user_type))
 
-        except Error as e:
+        except _pymysql().Error as e:
             print(e)
 
     def user_exists(self, user_email):
-        sql_query = 'SELECT * FROM users WHERE email=%s'
-        
+        sql_query = 'SELECT user_id FROM Users WHERE email=%s'
+
         try:
-            result = self.cursor.execute(sql_query, (user_email))
-            return result
+            return self.fetchone(sql_query, (user_email,)) is not None
 
-        except Error as e:
+        except _pymysql().Error as e:
             print(e)
 
+    # Login lookup, returns the Users row as a dict or None
     def get_existing_user(self, user_email):
-        sql_query = 'SELECT * FROM users WHERE email=%s'
-
-        try: 
-            self.cursor.execute(sql_query, (user_email))
-            result = self.cursor.fetchone()
-            
-            return result
-        
-        except Error as e:
-            print(e)
+        sql_query = 'SELECT user_id, name, email, password_hash, user_type, session_version FROM Users WHERE email=%s'
+        return self.fetchone(sql_query, (user_email,))
+
+    # Enrollment lookup, returns the user_ids actively enrolled in a class
+    def enrolled_user_ids(self, class_id):
+        sql_query = 'SELECT user_id FROM Enrollment WHERE class_id=%s AND dropped=0'
+        return [row['user_id'] for row in self.fetchall(sql_query, (class_id,))]
+
+    # Check-in lookup by primary key
+    def attendance_exists(self, class_id, user_id, date):
+        sql_query = 'SELECT 1 FROM Attendance WHERE class_id=%s AND user_id=%s AND date=%s'
+        return self.fetchone(sql_query, (class_id, user_id, date)) is not None
+
+    # Active enrollment lookup by primary key
+    def is_enrolled(self, class_id, user_id):
+        sql_query = 'SELECT 1 FROM Enrollment WHERE class_id=%s AND user_id=%s AND dropped=0'
+        return self.fetchone(sql_query, (class_id, user_id)) is not None
+
+    # Check-in write, one idempotent multi-row insert for all the given
+    # (class_id, user_id, date) rows, returns the number actually inserted
+    def insert_attendance(self, rows):
+        sql_query = 'INSERT IGNORE INTO Attendance (class_id, user_id, date) VALUES (%s, %s, %s)'
+        return self.executemany(sql_query, rows)
+
+    def _checkout(self):
+        try:
+            con, returned_at = self._idle.get_nowait()
+        except queue.Empty:
+            con = self._create()
+            if con is not None:
+                return con
+            try:
+                con, returned_at = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise PoolExhausted('No database connection free after {0}s (pool size {1})'.format(
+                    self.timeout, self.maxsize))
+
+        if time.time() - returned_at > self.ping_after:
+            try:
+                con.ping(reconnect=True)
+            except _pymysql().Error:
+                self._discard(con)
+                raise
+        return con
+
+    # Opens a new connection if the pool is below maxsize, else returns None
+    def _create(self):
+        with self._lock:
+            if self._created >= self.maxsize:
+                return None
+            self._created += 1
+        try:
+            pymysql = _pymysql()
+            return pymysql.connect(cursorclass=pymysql.cursors.DictCursor, **self._connect_args)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _checkin(self, con):
+        self._idle.put((con, time.time()))
+
+    # Rolls back whatever the failed block left behind, connections that
+    # cannot even do that are dropped instead of going back to the pool
+    def _release_after_error(self, con):
+        try:
+            con.rollback()
+        except _pymysql().Error:
+            self._discard(con)
+        else:
+            self._checkin(con)
+
+    def _discard(self, con):
+        with self._lock:
+            self._created -= 1
+        try:
+            con.close()
+        except _pymysql().Error:
+            pass
+
+    # Closes every idle connection
+    def close(self):
+        while True:
+            try:
+                con, returned_at = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(con)
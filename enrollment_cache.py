@@ -0,0 +1,103 @@
+from app import mysql_db
+from collections import OrderedDict
+from models import db, Enrollment
+import threading
+import time
+
+# In-process cache of class membership used by the check-in hot path.
+# Each class_id maps to a frozenset of the user_ids actively enrolled in it,
+# so answering "is this student enrolled" for a warm class costs no query.
+# Entries expire after a TTL and the least recently used class is evicted
+# once the cache is full. Every route that changes Enrollment must call
+# invalidate() for the class it touched.
+#
+# invalidate() only reaches this process. A student missing from a cached
+# set is therefore looked up in the database before being turned away, so
+# an enrollment made through another worker is honoured right away. A
+# student dropped through another worker is still accepted until the
+# entry expires after ENROLLMENT_CACHE_TTL.
+
+
+class EnrollmentCache():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bumped by invalidate(), a load that started before it does not
+        # store its possibly stale result
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('ENROLLMENT_CACHE_TTL', 300)
+        app.config.setdefault('ENROLLMENT_CACHE_SIZE', 1024)
+
+    def is_enrolled(self, class_id, user_id):
+        if user_id in self.members(class_id):
+            return True
+        # Possibly enrolled since the set was loaded
+        if self.app.config['RAW_SQL_HOT_PATHS']:
+            enrolled = mysql_db.is_enrolled(class_id, user_id)
+        else:
+            enrolled = db.session.query(Enrollment.user_id).filter_by(
+                class_id=class_id, user_id=user_id, dropped=False).first() is not None
+        if enrolled:
+            self.invalidate(class_id)
+        return enrolled
+
+    # Returns the set of user_ids actively enrolled in a class
+    def members(self, class_id):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(class_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(class_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        # Only the user_id column is loaded, no ORM objects are built
+        if self.app.config['RAW_SQL_HOT_PATHS']:
+            members = frozenset(mysql_db.enrolled_user_ids(class_id))
+        else:
+            rows = db.session.query(Enrollment.user_id).filter_by(
+                class_id=class_id, dropped=False).all()
+            members = frozenset(row.user_id for row in rows)
+
+        with self._lock:
+            if generation != self._generation:
+                return members
+            self._entries[class_id] = (now + self.app.config['ENROLLMENT_CACHE_TTL'], members)
+            self._entries.move_to_end(class_id)
+            while len(self._entries) > self.app.config['ENROLLMENT_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return members
+
+    def invalidate(self, class_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(class_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries)
+        }
+
+
+enrollment_cache = EnrollmentCache()
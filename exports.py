@@ -0,0 +1,70 @@
+from models import db, User, Classes, Attendance
+import archive
+import csv
+import io
+import json
+
+# Streaming attendance exports.
+# Rows are read through a server-side cursor in batches of EXPORT_BATCH_SIZE
+# with Users and Classes joined in by the query, and written out as they
+# arrive, so memory use stays flat however many rows are exported.
+
+COLUMNS = ('class_id', 'class_name', 'section', 'user_id', 'student_name', 'email', 'date')
+
+
+# Yields one tuple per attendance row, for one class or for all of them.
+# Archived terms come first, then the live rows ordered like the Attendance
+# primary key so no sort is needed.
+def attendance_rows(class_id=None, batch_size=1000):
+    for row in archive.archived_export_rows(class_id, batch_size):
+        yield row
+    query = db.session.query(
+        Attendance.class_id, Classes.name, Classes.section,
+        Attendance.user_id, User.name, User.email, Attendance.date) \
+        .join(Classes, Classes.class_id == Attendance.class_id) \
+        .join(User, User.user_id == Attendance.user_id)
+    if class_id is not None:
+        query = query.filter(Attendance.class_id == class_id)
+    query = query.order_by(Attendance.class_id, Attendance.user_id, Attendance.date) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+    for row in query:
+        yield tuple(row)
+
+
+# Both formats yield text in chunks of batch_size rows rather than per row
+def csv_chunks(rows, batch_size=1000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row[:-1] + (row[-1].isoformat(),))
+        if count % batch_size == 0:
+            yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def jsonl_chunks(rows, batch_size=1000):
+    lines = []
+    for row in rows:
+        record = dict(zip(COLUMNS, row))
+        record['date'] = record['date'].isoformat()
+        lines.append(json.dumps(record))
+        if len(lines) == batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'jsonl': (jsonl_chunks, 'application/x-ndjson'),
+}
+
+
+def _drain(buffer):
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
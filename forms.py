@@ -19,3 +19,11 @@ class RegistrationForm(FlaskForm):
                                 Required()])
     confirm_password = PasswordField('Confirm Password', [DataRequired(), EqualTo('password', message='Passwords must match')])
     submit_btn = SubmitField('Submit')
+
+# Claiming an account created by a roster import, the email is already known
+class ClaimForm(FlaskForm):
+    name = StringField('Name', [DataRequired(), Length(min=3, max=50), Required()])
+    password = PasswordField('Password', [DataRequired(), Length(min=8, max=25, message='Password should have a length of 8-25 characters'), 
+                                Required()])
+    confirm_password = PasswordField('Confirm Password', [DataRequired(), EqualTo('password', message='Passwords must match')])
+    submit_btn = SubmitField('Set Password')
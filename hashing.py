@@ -0,0 +1,118 @@
+from concurrent.futures import BrokenExecutor, TimeoutError
+from werkzeug.security import check_password_hash, generate_password_hash
+import threading
+
+# Password hashing off the request thread.
+# PBKDF2 is deliberately slow, so during a login storm the hashes run in a
+# bounded process pool instead of blocking every web worker. At most
+# HASH_QUEUE_DEPTH hashes may be running or waiting at once, callers beyond
+# that get HashingBusy immediately, and a hash that takes longer than
+# HASH_TIMEOUT seconds raises HashingBusy as well. HASH_POOL_SIZE = 0 hashes
+# inline, for platforms without multiprocessing support such as Lambda.
+# A pool broken by a worker process dying is replaced and the hash retried
+# once.
+#
+# PASSWORD_HASH_METHOD is the werkzeug method new hashes are made with.
+# Stored hashes made with other parameters are reported by needs_rehash()
+# so login can upgrade them transparently.
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class PasswordHasher():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000')
+        app.config.setdefault('HASH_POOL_SIZE', 2)
+        app.config.setdefault('HASH_QUEUE_DEPTH', 32)
+        app.config.setdefault('HASH_TIMEOUT', 5.0)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def generate(self, password):
+        return self._run(generate_password_hash, password,
+                         self.app.config['PASSWORD_HASH_METHOD'])
+
+    # True if the stored hash was made with other parameters than the
+    # configured method, e.g. an older iteration count
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.app.config['PASSWORD_HASH_METHOD']
+
+    # Stops the worker processes, the next hash starts a fresh pool with the
+    # current configuration
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor, self._slots = self._executor, None, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _run(self, fn, *args, retry=True):
+        executor, slots = self._pool()
+        if not slots.acquire(blocking=False):
+            raise HashingBusy('Too many password hashes queued')
+
+        if executor is None:
+            try:
+                return fn(*args)
+            finally:
+                slots.release()
+
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenExecutor:
+            slots.release()
+            return self._retry(executor, retry, fn, *args)
+        except Exception:
+            slots.release()
+            raise
+        # The slot is only freed once the worker is done, a timed out hash
+        # still occupies a process until it finishes
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            return future.result(timeout=self.app.config['HASH_TIMEOUT'])
+        except TimeoutError:
+            raise HashingBusy('Password hash timed out')
+        except BrokenExecutor:
+            return self._retry(executor, retry, fn, *args)
+
+    # A worker process that dies, e.g. killed for using too much memory,
+    # breaks the whole pool and every later submit() fails. The broken pool
+    # is dropped so _pool() starts a new one, and the hash is tried once more.
+    def _retry(self, broken, retry, fn, *args):
+        with self._lock:
+            if self._executor is broken:
+                self._executor, self._slots = None, None
+        broken.shutdown(wait=False)
+        if not retry:
+            raise HashingBusy('Password hashing pool broke')
+        self.app.logger.warning('Password hashing pool broke, starting a new one')
+        return self._run(fn, *args, retry=False)
+
+    # Created on first use so importing the app stays cheap and forked web
+    # workers do not inherit a parent's pool
+    def _pool(self):
+        with self._lock:
+            if self._slots is None:
+                size = self.app.config['HASH_POOL_SIZE']
+                if size > 0:
+                    # Not imported at startup, multiprocessing is only
+                    # loaded where a pool is used
+                    from concurrent.futures import ProcessPoolExecutor
+                    self._executor = ProcessPoolExecutor(max_workers=size)
+                self._slots = threading.BoundedSemaphore(self.app.config['HASH_QUEUE_DEPTH'])
+            return self._executor, self._slots
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,152 @@
+from app import mysql_db
+from collections import deque
+from models import db, insert_ignore, Attendance
+import atexit
+import threading
+
+# Write-behind ingest for attendance check-ins.
+# In 'sync' mode every check-in is written inside the request with a single
+# idempotent insert. In 'buffered' mode the request only validates the
+# check-in and queues it, and a background flusher writes the queued rows in
+# batches as one multi-row INSERT IGNORE against the Attendance primary key.
+
+
+class AttendanceIngest():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._queue = deque()
+        self._pending = set()
+        self._thread = None
+        self._stopping = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('ATTENDANCE_INGEST_MODE', 'sync')
+        app.config.setdefault('ATTENDANCE_FLUSH_SIZE', 200)
+        app.config.setdefault('ATTENDANCE_FLUSH_INTERVAL', 0.5)
+        app.config.setdefault('ATTENDANCE_MAX_PENDING', 10000)
+
+        # Whatever is still buffered when the process exits gets written
+        atexit.register(self.shutdown)
+
+    @property
+    def buffered(self):
+        return self.app.config['ATTENDANCE_INGEST_MODE'] == 'buffered'
+
+    # Records a check-in. Returns False when the check-in is already known,
+    # True otherwise. Written check-ins are known to the insert; buffered
+    # ones are checked against the buffer and then against the database with
+    # a primary key lookup. Another worker process may have written it, so
+    # nothing held in this process can stand in for that lookup.
+    def submit(self, class_id, user_id, date):
+        key = (class_id, user_id, date)
+
+        if self.buffered and not self._stopping:
+            with self._lock:
+                if key in self._pending:
+                    return False
+            if self._exists(key):
+                return False
+            with self._lock:
+                if key in self._pending:
+                    return False
+                if len(self._pending) < self.app.config['ATTENDANCE_MAX_PENDING']:
+                    self._pending.add(key)
+                    self._queue.append(key)
+                    self._ensure_flusher()
+                    if len(self._queue) >= self.app.config['ATTENDANCE_FLUSH_SIZE']:
+                        self._wakeup.set()
+                    return True
+
+        # Synchronous fallback: ingest is in sync mode, the buffer is full
+        # or the process is shutting down
+        return self._write([key]) == 1
+
+    # Writes everything currently buffered, flush size rows at a time
+    def flush(self):
+        flush_size = self.app.config['ATTENDANCE_FLUSH_SIZE']
+        while True:
+            with self._lock:
+                batch = [self._queue.popleft()
+                         for i in range(min(flush_size, len(self._queue)))]
+            if not batch:
+                return
+
+            try:
+                self._write(batch)
+            except Exception:
+                # Put the batch back in front of the queue and retry it on
+                # the next interval rather than dropping check-ins
+                self.app.logger.exception('Attendance flush of %d rows failed', len(batch))
+                with self._lock:
+                    self._queue.extendleft(reversed(batch))
+                return
+
+            with self._lock:
+                self._pending.difference_update(batch)
+
+    # Stops the flusher and drains the buffer
+    def shutdown(self, timeout=10):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        if self.app is not None and self._queue:
+            with self.app.app_context():
+                self.flush()
+
+    def pending_count(self):
+        return len(self._pending)
+
+    # Buffered check-ins for a class that have not been written yet
+    def pending(self, class_id):
+        with self._lock:
+            return [key for key in self._pending if key[0] == class_id]
+
+    def _exists(self, key):
+        if self.app.config['RAW_SQL_HOT_PATHS']:
+            return mysql_db.attendance_exists(*key)
+        class_id, user_id, date = key
+        return db.session.query(Attendance.class_id) \
+            .filter_by(class_id=class_id, user_id=user_id, date=date).first() is not None
+
+    # Runs a single multi-row idempotent insert, returns the inserted count.
+    # Needs an app context, the request's one or the flusher's own.
+    def _write(self, keys):
+        if self.app.config['RAW_SQL_HOT_PATHS']:
+            return mysql_db.insert_attendance(keys)
+
+        rows = [{'class_id': class_id, 'user_id': user_id, 'date': date}
+                for class_id, user_id, date in keys]
+        try:
+            result = db.session.execute(
+                insert_ignore(Attendance.__table__).values(rows))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return result.rowcount
+
+    # Starts the flusher thread on first use (and again after a fork)
+    def _ensure_flusher(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name='attendance-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.app.config['ATTENDANCE_FLUSH_INTERVAL'])
+            self._wakeup.clear()
+            with self.app.app_context():
+                self.flush()
+            if self._stopping:
+                return
+
+
+ingest = AttendanceIngest()
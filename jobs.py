@@ -0,0 +1,309 @@
+from enrollment_cache import enrollment_cache
+from models import db, bump_content_version, Attendance, AttendanceArchive, Classes, Enrollment, Job
+from reports import attendance_counters
+from sqlalchemy import func
+import archive
+import datetime
+import json
+import threading
+
+# Background jobs for work too slow for a web request: deleting a class
+# with its attendance, reports over every class and attendance compaction.
+# submit() records the job in the Jobs table and hands it to a pool of
+# JOB_WORKERS threads in this process; the request returns right away and
+# the client follows the job on /jobs/<job_id>. At most JOB_QUEUE_SIZE jobs
+# may be running or waiting per process, submit() raises JobsBusy beyond
+# that. JOB_WORKERS = 0 runs jobs inline, for tests and platforms without
+# background threads such as Lambda.
+#
+# A job is claimed by flipping its row from 'queued' to 'running', so it
+# runs once even when `flask run-jobs` picks up the same row. Jobs of a
+# worker that died are put back in the queue by requeue_stale(); every
+# handler is safe to run again after being interrupted. Nothing in the web
+# process looks for such jobs, nor for jobs still queued when it exited:
+# they only run once `flask run-jobs` does, so schedule it (e.g. from cron
+# every few minutes) wherever JOB_WORKERS is above 0.
+
+
+class JobsBusy(Exception):
+    pass
+
+
+class JobRunner():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self._handlers = {}
+        self._counts = dict((name, 0) for name in ('submitted', 'done', 'failed', 'rejected'))
+        self._running = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('JOB_WORKERS', 2)
+        app.config.setdefault('JOB_QUEUE_SIZE', 16)
+        app.config.setdefault('JOB_DELETE_CHUNK_SIZE', 1000)
+        app.config.setdefault('JOB_STALE_SECONDS', 600)
+
+    # Decorator registering fn(progress, **params) as the handler of a kind
+    # of job. It returns the JSON result and may call progress(done, total)
+    # between transactions.
+    def handler(self, kind):
+        def register(fn):
+            self._handlers[kind] = fn
+            return fn
+        return register
+
+    # Records a job and starts it in the background, returns the Job.
+    # Commits the current session.
+    def submit(self, kind, owner_id=None, **params):
+        if kind not in self._handlers:
+            raise ValueError('Unknown job kind {0}'.format(kind))
+        executor, slots = self._pool()
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self._counts['rejected'] += 1
+            raise JobsBusy('Too many jobs queued')
+
+        try:
+            job = Job(kind=kind, owner_id=owner_id, params=json.dumps(params), status='queued',
+                      done=0, created_at=_now())
+            db.session.add(job)
+            db.session.commit()
+        except Exception:
+            slots.release()
+            db.session.rollback()
+            raise
+        with self._lock:
+            self._counts['submitted'] += 1
+
+        if executor is None:
+            try:
+                self.run(job.job_id)
+            finally:
+                slots.release()
+            db.session.refresh(job)
+            return job
+
+        try:
+            future = executor.submit(self._run_in_context, job.job_id)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+        return job
+
+    # Runs a queued job in the current thread, needs an app context.
+    # Returns False if it was not queued, e.g. another worker claimed it.
+    def run(self, job_id):
+        now = _now()
+        claimed = Job.query.filter_by(job_id=job_id, status='queued') \
+            .update({'status': 'running', 'started_at': now, 'updated_at': now}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return False
+
+        kind, params = db.session.query(Job.kind, Job.params).filter_by(job_id=job_id).one()
+        with self._lock:
+            self._running += 1
+        try:
+            result = self._handlers[kind](lambda done, total: self._progress(job_id, done, total),
+                                          **json.loads(params))
+        except Exception as error:
+            db.session.rollback()
+            self.app.logger.exception('Job %d (%s) failed', job_id, kind)
+            self._finish(job_id, status='failed', error=str(error)[:500])
+            outcome = 'failed'
+        else:
+            self._finish(job_id, status='done', result=json.dumps(result))
+            outcome = 'done'
+        finally:
+            with self._lock:
+                self._running -= 1
+        with self._lock:
+            self._counts[outcome] += 1
+        return True
+
+    # Runs every queued job in the current thread, oldest first, returns
+    # how many this call ran
+    def run_pending(self):
+        ran = 0
+        while True:
+            job_id = db.session.query(Job.job_id).filter_by(status='queued').order_by(Job.job_id).limit(1).scalar()
+            if job_id is None:
+                return ran
+            if self.run(job_id):
+                ran += 1
+
+    # Puts jobs that stopped reporting progress JOB_STALE_SECONDS ago back
+    # in the queue, returns how many
+    def requeue_stale(self):
+        cutoff = _now() - datetime.timedelta(seconds=self.app.config['JOB_STALE_SECONDS'])
+        count = Job.query.filter(Job.status == 'running', Job.updated_at < cutoff) \
+            .update({'status': 'queued'}, synchronize_session=False)
+        db.session.commit()
+        return count
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['running'] = self._running
+            return stats
+
+    def _run_in_context(self, job_id):
+        with self.app.app_context():
+            try:
+                self.run(job_id)
+            except Exception:
+                # Failing to claim or finish the job, it stays where it was
+                # and requeue_stale() picks it up later
+                self.app.logger.exception('Job %d could not be run', job_id)
+
+    # On a connection of its own, so a handler can report progress while its
+    # session is still reading a result stream, and without committing the
+    # handler's work
+    def _progress(self, job_id, done, total):
+        with db.engine.begin() as connection:
+            connection.execute(Job.__table__.update().where(Job.job_id == job_id)
+                               .values(done=done, total=total, updated_at=_now()))
+
+    def _finish(self, job_id, **values):
+        now = _now()
+        values.update(updated_at=now, finished_at=now)
+        Job.query.filter_by(job_id=job_id).update(values, synchronize_session=False)
+        db.session.commit()
+
+    # Created on first use, like the password hashing pool, so forked web
+    # workers do not inherit a parent's threads
+    def _pool(self):
+        with self._lock:
+            if self._slots is None:
+                workers = self.app.config['JOB_WORKERS']
+                if workers > 0:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+                self._slots = threading.BoundedSemaphore(self.app.config['JOB_QUEUE_SIZE'])
+            return self._executor, self._slots
+
+
+jobs = JobRunner()
+
+
+# Status of a job as returned by /jobs/<job_id>
+def describe(job):
+    return {
+        'job_id': job.job_id,
+        'kind': job.kind,
+        'status': job.status,
+        'done': job.done,
+        'total': job.total,
+        'progress': round(float(job.done) / job.total, 4) if job.total else (1.0 if job.status == 'done' else 0.0),
+        'result': json.loads(job.result) if job.result is not None else None,
+        'error': job.error,
+        'created_at': _isoformat(job.created_at),
+        'started_at': _isoformat(job.started_at),
+        'finished_at': _isoformat(job.finished_at),
+    }
+
+
+def _now():
+    return datetime.datetime.utcnow().replace(microsecond=0)
+
+
+def _isoformat(value):
+    return value.isoformat() + 'Z' if value is not None else None
+
+
+# Deletes a class in transactions of about JOB_DELETE_CHUNK_SIZE rows, so
+# no single DELETE holds locks on a whole term of attendance. Attendance
+# and archive rows go first, grouped by student, then the enrollments and
+# finally the class itself, whose ON DELETE CASCADE only has the check-ins
+# that arrived in the meantime left to remove.
+@jobs.handler('delete_class')
+def delete_class(progress, class_id):
+    professor_id = db.session.query(Classes.professor_id).filter_by(class_id=class_id).scalar()
+    if professor_id is None:
+        return {'class_id': class_id, 'deleted': 0}
+
+    chunk_size = jobs.app.config['JOB_DELETE_CHUNK_SIZE']
+    attendance = db.session.query(Attendance.user_id, func.count()) \
+        .filter(Attendance.class_id == class_id).group_by(Attendance.user_id).all()
+    archived = db.session.query(AttendanceArchive.user_id, func.count()) \
+        .filter(AttendanceArchive.class_id == class_id).group_by(AttendanceArchive.user_id).all()
+    students = [row[0] for row in db.session.query(Enrollment.user_id).filter_by(class_id=class_id)]
+    total = sum(count for user_id, count in attendance) + sum(count for user_id, count in archived) + \
+        len(students) + 1
+    done = 0
+    progress(done, total)
+
+    for model, counts in ((Attendance, attendance), (AttendanceArchive, archived)):
+        for user_ids, rows in _chunks(counts, chunk_size):
+            model.query.filter(model.class_id == class_id, model.user_id.in_(user_ids)) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            done += rows
+            progress(done, total)
+
+    for start in range(0, len(students), chunk_size):
+        user_ids = students[start:start + chunk_size]
+        Enrollment.query.filter(Enrollment.class_id == class_id, Enrollment.user_id.in_(user_ids)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        done += len(user_ids)
+        progress(done, total)
+
+    # The teacher's and every formerly enrolled student's dashboard list it
+    bump_content_version([professor_id] + students)
+    Classes.query.filter_by(class_id=class_id).delete(synchronize_session=False)
+    db.session.commit()
+    enrollment_cache.invalidate(class_id)
+    attendance_counters.invalidate(class_id)
+    progress(total, total)
+    return {'class_id': class_id, 'deleted': total}
+
+
+# Groups (user_id, rows) pairs into ([user_id, ...], rows) of about chunk_size rows
+def _chunks(counts, chunk_size):
+    user_ids, rows = [], 0
+    for user_id, count in counts:
+        if user_ids and rows + count > chunk_size:
+            yield user_ids, rows
+            user_ids, rows = [], 0
+        user_ids.append(user_id)
+        rows += count
+    if user_ids:
+        yield user_ids, rows
+
+
+# Classes summarized between two progress updates of a department report
+REPORT_PROGRESS_EVERY = 100
+
+
+# Analytics summary of one class, or of every class when class_id is None
+@jobs.handler('attendance_report')
+def attendance_report(progress, threshold, class_id=None):
+    # NumPy is only imported when a report is run, not at startup
+    import analytics
+    if class_id is not None:
+        return analytics.load_class_matrix(class_id).summary(threshold)
+
+    # Only the summaries are kept
+    total = analytics.class_count()
+    summaries = []
+    progress(0, total)
+    for summary in analytics.department_report(threshold):
+        summaries.append(summary)
+        if len(summaries) % REPORT_PROGRESS_EVERY == 0:
+            progress(len(summaries), total)
+    progress(len(summaries), total)
+    return summaries
+
+
+# Moves attendance of closed terms into the archive, see archive.py
+@jobs.handler('compact_attendance')
+def compact_attendance(progress):
+    return archive.compact(progress=progress)
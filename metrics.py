@@ -0,0 +1,182 @@
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import threading
+import time
+
+# Per-request SQL and latency instrumentation.
+# Flask request hooks time every request and SQLAlchemy cursor events count
+# the queries, DB time and rows it costs. Samples are kept in a rolling
+# window per endpoint and published on /metrics in the Prometheus text
+# format, with p50/p95/p99 quantiles computed when the endpoint is scraped.
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# name -> help text, in the order they are published
+REQUEST_METRICS = (
+    ('latency_seconds', 'Total request latency'),
+    ('db_seconds', 'Time spent executing SQL'),
+    ('queries', 'SQL statements executed'),
+    ('rows', 'Rows fetched or affected'),
+)
+
+
+class Metrics():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._windows = defaultdict(lambda: defaultdict(deque))
+        self._counts = defaultdict(int)
+        self._sums = defaultdict(lambda: defaultdict(float))
+        self._collectors = []
+        self._budgets = threading.local()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('METRICS_WINDOW', 1024)
+        app.config.setdefault('METRICS_SERVER_TIMING', False)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+        # Listening on the Engine class covers every engine, including ones
+        # created lazily after this runs
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    # Registers a callable returning {name: value}, published as gauges
+    # named attendance_<prefix>_<name>
+    def register_collector(self, prefix, collector):
+        self._collectors.append((prefix, collector))
+
+    # Returns {endpoint: {metric: {quantile: value}}} for the current window
+    def snapshot(self):
+        with self._lock:
+            windows = dict((endpoint, dict((name, sorted(samples)) for name, samples in metrics.items()))
+                           for endpoint, metrics in self._windows.items())
+        return dict((endpoint, dict((name, dict((q, _quantile(samples, q)) for q in QUANTILES))
+                                    for name, samples in metrics.items()))
+                    for endpoint, metrics in windows.items())
+
+    # Returns {endpoint: {'requests': count, metric: sum}} over every request
+    # so far. Two calls give per-request averages for what ran in between.
+    def totals(self):
+        with self._lock:
+            return dict((endpoint, dict(self._sums[endpoint], requests=count))
+                        for endpoint, count in self._counts.items())
+
+    def view(self):
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    # Renders every metric in the Prometheus text exposition format
+    def render(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, description in REQUEST_METRICS:
+            metric = 'attendance_request_' + name
+            lines.append('# HELP {0} {1} per request.'.format(metric, description))
+            lines.append('# TYPE {0} summary'.format(metric))
+            for endpoint in sorted(snapshot):
+                for q, value in sorted(snapshot[endpoint][name].items()):
+                    lines.append('{0}{{endpoint="{1}",quantile="{2}"}} {3}'.format(metric, endpoint, q, value))
+                lines.append('{0}_sum{{endpoint="{1}"}} {2}'.format(metric, endpoint, self._sums[endpoint][name]))
+                lines.append('{0}_count{{endpoint="{1}"}} {2}'.format(metric, endpoint, self._counts[endpoint]))
+
+        for prefix, collector in self._collectors:
+            for name, value in sorted(collector().items()):
+                metric = 'attendance_{0}_{1}'.format(prefix, name)
+                lines.append('# TYPE {0} gauge'.format(metric))
+                lines.append('{0} {1}'.format(metric, value))
+        return '\n'.join(lines) + '\n'
+
+    # Fails with AssertionError when the block runs more than max_queries
+    # SQL statements on this thread. Meant for tests guarding against N+1
+    # regressions, e.g.
+    #
+    #     with metrics.query_budget(3):
+    #         client.get('/student_dashboard')
+    #
+    # benchmarks/check_query_budgets.py checks the dashboards this way.
+    @contextmanager
+    def query_budget(self, max_queries):
+        statements = []
+        stack = self._budget_stack()
+        stack.append(statements)
+        try:
+            yield statements
+        finally:
+            stack.pop()
+        if len(statements) > max_queries:
+            raise AssertionError('{0} queries run, budget is {1}:\n{2}'.format(
+                len(statements), max_queries, '\n'.join(statements)))
+
+    def _budget_stack(self):
+        if not hasattr(self._budgets, 'stack'):
+            self._budgets.stack = []
+        return self._budgets.stack
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_db_time = 0.0
+        g.metrics_rows = 0
+
+    def _finish_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+
+        latency = time.perf_counter() - g.metrics_start
+        sample = {
+            'latency_seconds': latency,
+            'db_seconds': g.metrics_db_time,
+            'queries': g.metrics_queries,
+            'rows': g.metrics_rows,
+        }
+        endpoint = request.endpoint or 'unmatched'
+        window = self.app.config['METRICS_WINDOW']
+        with self._lock:
+            self._counts[endpoint] += 1
+            for name, value in sample.items():
+                samples = self._windows[endpoint][name]
+                samples.append(value)
+                if len(samples) > window:
+                    samples.popleft()
+                self._sums[endpoint][name] += value
+
+        if self.app.config['METRICS_SERVER_TIMING']:
+            response.headers['Server-Timing'] = \
+                'db;dur={0:.2f};desc="{1} queries", total;dur={2:.2f}'.format(
+                    g.metrics_db_time * 1000, g.metrics_queries, latency * 1000)
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_query_start'].pop()
+
+        for statements in self._budget_stack():
+            statements.append(statement)
+
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_queries += 1
+            g.metrics_db_time += elapsed
+            if cursor.rowcount > 0:
+                g.metrics_rows += cursor.rowcount
+
+
+# Nearest-rank quantile of an already sorted list
+def _quantile(samples, q):
+    if not samples:
+        return 0
+    index = min(len(samples) - 1, int(round(q * (len(samples) - 1))))
+    return samples[index]
+
+
+metrics = Metrics()
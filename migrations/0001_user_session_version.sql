@@ -0,0 +1,3 @@
+-- Per-user version counter behind the session snapshots (USER_SNAPSHOT_MODE).
+-- Bumping it forces every session of that user to reload the user row.
+ALTER TABLE Users ADD COLUMN session_version INT NOT NULL DEFAULT 0;
@@ -0,0 +1,7 @@
+-- Unique indexes on both class codes. They make code lookups index seeks
+-- instead of full scans of Classes and reject colliding codes on insert.
+-- Fails if existing rows already share a code; regenerate those first.
+-- attendance_code is nullable, any number of classes may have no code.
+ALTER TABLE Classes
+    ADD UNIQUE KEY uq_classes_enrollment_code (enrollment_code),
+    ADD UNIQUE KEY uq_classes_attendance_code (attendance_code);
@@ -0,0 +1,12 @@
+-- Compacted store for attendance of closed terms, filled by
+-- `flask compact-attendance`. One row per (class, student, term) holding a
+-- bitmap of the days of the term the student attended.
+CREATE TABLE AttendanceArchive (
+  class_id INT NOT NULL,
+  user_id INT NOT NULL,
+  term INT NOT NULL,
+  sessions VARBINARY(32) NOT NULL,
+  PRIMARY KEY(class_id, user_id, term),
+  FOREIGN KEY(class_id) REFERENCES Classes(class_id) ON DELETE CASCADE,
+  FOREIGN KEY(user_id) REFERENCES Users(user_id)
+);
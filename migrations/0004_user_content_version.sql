@@ -0,0 +1,4 @@
+-- Per-user version of the dashboard class list. The dashboards use it as
+-- their ETag and as the key of the cached class-list fragment, see
+-- page_cache.py. Bumped on enroll, unenroll and class changes.
+ALTER TABLE Users ADD COLUMN content_version INT NOT NULL DEFAULT 0;
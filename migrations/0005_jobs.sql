@@ -0,0 +1,22 @@
+-- Background jobs run by jobs.py: class deletion, reports and attendance
+-- compaction. Rows are kept after the job finishes so its status and
+-- result can be read back from /jobs/<job_id>.
+CREATE TABLE Jobs (
+  job_id INT NOT NULL AUTO_INCREMENT,
+  kind VARCHAR(50) NOT NULL,
+  owner_id INT,
+  params TEXT NOT NULL,
+  status ENUM('queued', 'running', 'done', 'failed') NOT NULL DEFAULT 'queued',
+  done INT NOT NULL DEFAULT 0,
+  total INT,
+  result LONGTEXT,
+  error VARCHAR(500),
+  created_at DATETIME NOT NULL,
+  started_at DATETIME,
+  updated_at DATETIME,
+  finished_at DATETIME,
+  PRIMARY KEY(job_id),
+  INDEX jobs_status (status, updated_at),
+  INDEX jobs_owner (owner_id, job_id),
+  FOREIGN KEY(owner_id) REFERENCES Users(user_id) ON DELETE SET NULL
+);
@@ -1,7 +1,9 @@
 from app import db, login_manager
+from flask import current_app, session
 from flask_login import UserMixin, current_user
 from functools import wraps
-from werkzeug.security import check_password_hash, generate_password_hash
+from hashing import password_hasher
+import time
 
 # Python abstraction of the Users table that extends the UserMixin class for
 # user authentication
@@ -14,11 +16,21 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(100), nullable=False, unique=True)
     password_hash = db.Column(db.String(150), nullable=False, unique=True)
     user_type = db.Column(db.Enum('teacher', 'student'))
-    #classes = db.relationship('Classes', backref='users', lazy=True)
-    #enrollments = db.relationship('Enrollment', backref='users', lazy=True)
+    # Raising it throws away the user's session snapshots once their
+    # USER_SNAPSHOT_TTL runs out, see _snapshot_user()
+    session_version = db.Column(db.Integer, nullable=False, default=0)
+    # Bumped whenever the class list on this user's dashboard changes, see
+    # bump_content_version() and page_cache.py
+    content_version = db.Column(db.Integer, nullable=False, default=0)
+    # Collections load lazily, routes that walk them ask for selectinload().
+    # The reverse many-to-one sides are declared through the backrefs.
+    classes = db.relationship('Classes', backref='professor', lazy='select')
+    enrollments = db.relationship('Enrollment', backref=db.backref('student', lazy='joined'), lazy='select')
+    attendance = db.relationship('Attendance', backref='student', lazy='dynamic')
 
+    # Hashed in the bounded worker pool, raises HashingBusy when it is full
     def check_password(self, cleartext):
-        if check_password_hash(self.password_hash, cleartext):
+        if password_hasher.check(self.password_hash, cleartext):
             return True
         else:
             return False
@@ -36,11 +48,63 @@ class User(db.Model, UserMixin):
             user_type=self.user_type
         )
 
+# Stand-in for User built from the signed session cookie, carries just what
+# login_required and the templates read
+class UserSnapshot(UserMixin):
+    def __init__(self, snapshot):
+        self.user_id = snapshot['user_id']
+        self.name = snapshot['name']
+        self.user_type = snapshot['user_type']
+        self.session_version = snapshot['version']
+
+    def get_id(self):
+        return self.user_id
+
+    def get_user_type(self):
+        return self.user_type
+
+
+# Stores the parts of the user every request needs in the session, so later
+# requests can be served without loading the user
+def store_user_snapshot(user):
+    session['user_snapshot'] = {
+        'user_id': user.user_id,
+        'name': user.name,
+        'user_type': user.user_type,
+        'version': user.session_version or 0,
+        'checked_at': time.time()
+    }
+
+
+# A snapshot is trusted until USER_SNAPSHOT_TTL runs out, then its version is
+# checked against the database with a single-column query.
+def _snapshot_user(user_id):
+    snapshot = session.get('user_snapshot')
+    if not snapshot or str(snapshot['user_id']) != str(user_id):
+        return None
+
+    if time.time() - snapshot['checked_at'] > current_app.config['USER_SNAPSHOT_TTL']:
+        version = db.session.query(User.session_version).filter_by(user_id=snapshot['user_id']).scalar()
+        if version != snapshot['version']:
+            return None
+        snapshot['checked_at'] = time.time()
+        session['user_snapshot'] = snapshot
+
+    return UserSnapshot(snapshot)
+
 # function responsible for handling the user during the current
 # session. Handles the logging in and out of users
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    if current_app.config['USER_SNAPSHOT_MODE']:
+        user = _snapshot_user(user_id)
+        if user is not None:
+            return user
+
+    user = User.query.get(user_id)
+    if user is not None and current_app.config['USER_SNAPSHOT_MODE']:
+        store_user_snapshot(user)
+    return user
 
 # Defined a custom user login_required decorator
 # to implement roles for the applications
@@ -68,11 +132,19 @@ class Classes(db.Model):
     class_id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
     section = db.Column(db.String(50), nullable=False)
-    attendance_code = db.Column(db.String(50), nullable=True)
-    enrollment_code = db.Column(db.String(50), nullable=False)
+    # Both codes are looked up by value, the unique indexes serve those
+    # lookups and reject colliding codes, see codes.py
+    attendance_code = db.Column(db.String(50), nullable=True, unique=True)
+    enrollment_code = db.Column(db.String(50), nullable=False, unique=True)
     professor_id = db.Column(db.Integer, db.ForeignKey(
         'Users.user_id'), nullable=False)
-    #enrollments = db.relationship('Enrollment', backref='classes', lazy=True)
+    # Rows of both tables are removed by ON DELETE CASCADE in the database,
+    # passive_deletes keeps the ORM from loading them first on class deletion
+    enrollments = db.relationship('Enrollment', backref=db.backref('linked_class', lazy='joined'),
+                                  lazy='select', cascade='all, delete-orphan', passive_deletes=True)
+    # A full term of attendance is large, it is always queried, never loaded
+    attendance = db.relationship('Attendance', backref='linked_class', lazy='dynamic',
+                                 cascade='all, delete-orphan', passive_deletes=True)
 
     def get_id(self):
         return self.class_id
@@ -110,12 +182,11 @@ class Enrollment(db.Model):
     def get_user_id(self):
         return self.user_id
     
+    # linked_class and student are joined in when the Enrollment is loaded
     def __repr__(self):
-        linked_class = Classes.query.get(self.class_id)
-        student = User.query.get(self.user_id)
         return "Class: {linked_class} | Student: {student}".format(
-            linked_class=linked_class, 
-            student=student
+            linked_class=self.linked_class, 
+            student=self.student
         )
 
 
@@ -132,11 +203,61 @@ class Attendance(db.Model):
     def get_id(self):
         return self.class_id + self.user_id + self.date
     
+    # Many-to-one lazy loads look in the session's identity map first, so
+    # repeated classes and students cost at most one query per request each
     def __repr__(self):
-        linked_class = Classes.query.get(self.class_id)
-        student = User.query.get(self.user_id)
         return "Class: {linked_class} | Student: {student} | Date: {date}".format(
-            linked_class=linked_class, 
-            student=student,
+            linked_class=self.linked_class, 
+            student=self.student,
             date = self.date
         )
+
+
+class AttendanceArchive(db.Model):
+    """Flask SQLAlchemy class representing AttendanceArchive table in database"""
+    # One row per student, class and closed term. Bit i of `sessions` is set
+    # when the student attended on day i of the term, see archive.py.
+    __tablename__ = 'AttendanceArchive'
+    class_id = db.Column(db.Integer, db.ForeignKey(
+        'Classes.class_id'), nullable=False, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        'Users.user_id'), nullable=False, primary_key=True)
+    term = db.Column(db.Integer, nullable=False, primary_key=True)
+    sessions = db.Column(db.VARBINARY(32), nullable=False)
+
+class Job(db.Model):
+    """Flask SQLAlchemy class representing Jobs table in database"""
+    # A background job run by jobs.py. `params` and `result` hold JSON,
+    # `done` out of `total` is the progress the job last reported.
+    __tablename__ = 'Jobs'
+    job_id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey(
+        'Users.user_id'), nullable=True)
+    params = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Enum('queued', 'running', 'done', 'failed'), nullable=False, default='queued')
+    done = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    # Touched on every progress report, jobs of a worker that died stop
+    # being updated, see jobs.requeue_stale()
+    updated_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# Invalidates the cached dashboards of the given users, call before
+# committing the enrollment or class change that made them stale
+def bump_content_version(user_ids):
+    user_ids = list(user_ids)
+    if user_ids:
+        User.query.filter(User.user_id.in_(user_ids)) \
+            .update({User.content_version: User.content_version + 1}, synchronize_session=False)
+
+# Builds an INSERT for the given table that silently skips rows colliding
+# with an existing primary key, so batched and retried writes are idempotent
+def insert_ignore(table):
+    return table.insert() \
+        .prefix_with('IGNORE', dialect='mysql') \
+        .prefix_with('OR IGNORE', dialect='sqlite')
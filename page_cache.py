@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from flask import Response, render_template, request
+from flask_login import current_user
+from hashlib import sha1
+from markupsafe import Markup
+import sys
+import threading
+import time
+
+# Conditional responses and rendered-fragment caching for the pages that
+# rarely change.
+#
+# Static pages (index, about) only depend on the kind of visitor, so each
+# is rendered once per kind on its first request and served with an ETag
+# and Last-Modified. The dashboards carry an ETag built from the user's
+# content_version, so an unchanged dashboard costs one primary key lookup
+# and a 304. When it did change, the class-list section is taken from an
+# LRU of rendered fragments keyed by the same version, capped at
+# PAGE_CACHE_MAX_BYTES. Routes that change what a dashboard lists call
+# models.bump_content_version() for the users concerned.
+
+
+# Stands in for current_user when rendering a static page for a kind of visitor
+class Visitor():
+    def __init__(self, kind):
+        self.kind = kind
+        self.is_anonymous = kind == 'anonymous'
+        self.is_authenticated = not self.is_anonymous
+
+    def get_user_type(self):
+        return self.kind
+
+
+class PageCache():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+        self._bytes = 0
+        self._static = {}
+        self._static_pages = {}
+        self.started = None
+        self._build_id = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.static_hits = 0
+        self.not_modified = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PAGE_CACHE_MAX_BYTES', 8 * 1024 * 1024)
+        # Last-Modified of the static pages
+        self.started = time.time()
+
+    # Part of every ETag so a deploy with changed templates starts over,
+    # while every worker of one deploy agrees. Reading every template is
+    # left to the first request rather than the cold start.
+    @property
+    def build_id(self):
+        if self._build_id is None:
+            digest = sha1()
+            jinja_env = self.app.jinja_env
+            for name in sorted(jinja_env.list_templates()):
+                digest.update(name.encode('utf-8'))
+                digest.update(jinja_env.loader.get_source(jinja_env, name)[0].encode('utf-8'))
+            self._build_id = digest.hexdigest()[:12]
+        return self._build_id
+
+    # Registers a page rendered once per kind of visitor
+    def add_static(self, name, template, **context):
+        self._static_pages[name] = (template, context)
+
+    def static_response(self, name):
+        kind = 'anonymous' if current_user.is_anonymous else current_user.get_user_type()
+        # Kept per script root prefix, the links differ behind one
+        page = self._static.get((name, kind, request.script_root))
+        if page is None:
+            page = self._render_static(name, kind)
+        else:
+            self.static_hits += 1
+
+        body, etag = page
+        response = Response(body, mimetype='text/html')
+        response.last_modified = self.started
+        return self.conditional(response, etag)
+
+    # Adds the ETag and turns the response into a 304 when the client's copy
+    # is current. Pages differ per user, so shared caches must not keep them.
+    def conditional(self, response, etag):
+        response = self._revalidate(response, etag).make_conditional(request)
+        if response.status_code == 304:
+            self.not_modified += 1
+        return response
+
+    # A 304 when the request already holds the page with this ETag, None
+    # otherwise. Checked before building the page, which then is not needed.
+    def not_modified_response(self, etag):
+        if etag not in request.if_none_match:
+            return None
+        self.not_modified += 1
+        return self._revalidate(Response(status=304), etag)
+
+    def etag(self, *parts):
+        return '-'.join(str(part) for part in parts + (self.build_id,))
+
+    # Returns the cached fragment for key, calling render() for the markup
+    # and caching it on a miss
+    def fragment(self, key, render):
+        with self._lock:
+            value = self._fragments.get(key)
+            if value is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return Markup(value)
+            self.misses += 1
+
+        value = str(render())
+        size = sys.getsizeof(value)
+        with self._lock:
+            if key not in self._fragments:
+                self._fragments[key] = value
+                self._bytes += size
+            while self._bytes > self.app.config['PAGE_CACHE_MAX_BYTES'] and self._fragments:
+                evicted = self._fragments.popitem(last=False)[1]
+                self._bytes -= sys.getsizeof(evicted)
+                self.evictions += 1
+        return Markup(value)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(float(self.hits) / lookups, 4) if lookups else 0,
+            'evictions': self.evictions,
+            'entries': len(self._fragments),
+            'bytes': self._bytes,
+            'static_hits': self.static_hits,
+            'not_modified': self.not_modified,
+        }
+
+    def _revalidate(self, response, etag):
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+
+    # Returns (body, etag) and keeps it for later requests
+    def _render_static(self, name, kind):
+        template, context = self._static_pages[name]
+        body = render_template(template, current_user=Visitor(kind), **context)
+        page = (body, self.etag(name, kind, sha1(body.encode('utf-8')).hexdigest()[:12]))
+        self._static[(name, kind, request.script_root)] = page
+        return page
+
+
+page_cache = PageCache()
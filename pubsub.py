@@ -0,0 +1,244 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+# Publish/subscribe for live updates, e.g. check-ins pushed to the teacher's
+# live counter. Subscribers get their own bounded queue; a subscriber that
+# falls behind loses messages rather than slowing down publishers.
+#
+# With PUBSUB_BACKEND 'local' messages only reach subscribers in the same
+# process. With 'socket' every worker process keeps one connection to a
+# broker listening on the unix socket PUBSUB_SOCKET (`flask pubsub-broker`),
+# which relays each message to all workers, the publisher included.
+
+
+class Subscription():
+    def __init__(self, hub, channel, maxsize):
+        self.hub = hub
+        self.channel = channel
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+
+    # Next message, or None if nothing arrived within timeout seconds
+    def get(self, timeout=None):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LocalBackend():
+    def __init__(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, channel, message):
+        self.deliver(channel, message)
+
+
+class SocketBackend():
+    def __init__(self, deliver, path, logger):
+        self.deliver = deliver
+        self.path = path
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+
+    # Live updates are best effort: if the broker cannot be reached the
+    # message is delivered in this process only
+    def publish(self, channel, message):
+        line = json.dumps({'channel': channel, 'message': message}).encode('utf-8') + b'\n'
+        with self._lock:
+            try:
+                self._connect()
+                self._sock.sendall(line)
+                return
+            except OSError:
+                self.logger.warning('Pub/sub broker at %s unreachable', self.path)
+                self._disconnect()
+        self.deliver(channel, message)
+
+    def start(self):
+        with self._lock:
+            try:
+                self._connect()
+            except OSError:
+                self.logger.warning('Pub/sub broker at %s unreachable', self.path)
+
+    def _connect(self):
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self._sock = sock
+        if self._reader is None:
+            self._reader = threading.Thread(target=self._read, name='pubsub-reader', daemon=True)
+            self._reader.start()
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    # Fans messages relayed by the broker out to this process's subscribers,
+    # reconnecting after a second when the broker goes away
+    def _read(self):
+        while True:
+            with self._lock:
+                sock = self._sock
+            if sock is None:
+                time.sleep(1)
+                with self._lock:
+                    try:
+                        self._connect()
+                    except OSError:
+                        continue
+                continue
+            try:
+                for line in sock.makefile('rb'):
+                    data = json.loads(line.decode('utf-8'))
+                    self.deliver(data['channel'], data['message'])
+            except (OSError, ValueError):
+                pass
+            with self._lock:
+                if self._sock is sock:
+                    self._disconnect()
+
+
+class PubSub():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._backend = None
+        self._published = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PUBSUB_BACKEND', 'local')
+        app.config.setdefault('PUBSUB_SOCKET', '/tmp/attendance-pubsub.sock')
+        app.config.setdefault('PUBSUB_QUEUE_SIZE', 256)
+
+    def publish(self, channel, message):
+        self._published += 1
+        self._get_backend().publish(channel, message)
+
+    def subscribe(self, channel):
+        # Starts the backend so messages from other workers are received
+        self._get_backend()
+        subscription = Subscription(self, channel, self.app.config['PUBSUB_QUEUE_SIZE'])
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': sum(len(subscribers) for subscribers in self._subscribers.values()),
+                'published': self._published,
+            }
+
+    def _deliver(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(message)
+
+    # The backend is created on first use, after the worker process forked
+    def _get_backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    if self.app.config['PUBSUB_BACKEND'] == 'socket':
+                        backend = SocketBackend(self._deliver, self.app.config['PUBSUB_SOCKET'], self.app.logger)
+                        backend.start()
+                    else:
+                        backend = LocalBackend(self._deliver)
+                    self._backend = backend
+        return self._backend
+
+
+pubsub = PubSub()
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # A worker that stops reading is dropped instead of stalling the rest.
+        # Set on the socket rather than with settimeout(), which would also
+        # time out the blocking reads below.
+        seconds = self.server.send_timeout
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                                   struct.pack('ll', int(seconds), int(seconds % 1 * 1000000)))
+        with self.server.lock:
+            self.server.clients.add(self.connection)
+        try:
+            for line in self.rfile:
+                self.server.relay(line)
+        except OSError:
+            pass
+        finally:
+            with self.server.lock:
+                self.server.clients.discard(self.connection)
+
+
+class Broker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, send_timeout=1.0):
+        if os.path.exists(path):
+            os.remove(path)
+        self.lock = threading.Lock()
+        # Held while sending so lines relayed by different handler threads
+        # never interleave on a client socket
+        self.send_lock = threading.Lock()
+        self.clients = set()
+        self.send_timeout = send_timeout
+        socketserver.UnixStreamServer.__init__(self, path, _BrokerHandler)
+
+    def relay(self, line):
+        with self.lock:
+            clients = list(self.clients)
+        with self.send_lock:
+            for client in clients:
+                try:
+                    client.sendall(line)
+                except OSError:
+                    with self.lock:
+                        self.clients.discard(client)
+                    try:
+                        client.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
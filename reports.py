@@ -0,0 +1,209 @@
+from collections import OrderedDict
+from models import db, User, Enrollment, Attendance
+from ingest import ingest
+import archive
+from sqlalchemy import and_, case, func, select
+import datetime
+import threading
+import time
+
+# Attendance percentage reporting for teacher_class_page.
+# attendance_report() answers for any number of classes with one set-based
+# GROUP BY query. AttendanceCounters keeps the result per class in memory
+# and mark_attendance bumps it on every new check-in, so rendering a class
+# page normally costs no reporting query at all.
+
+
+# Returns {class_id: [(name, percentage, attended, total), ...]} for every
+# actively enrolled student of the given classes, ordered by name
+def attendance_report(class_ids, today=None):
+    report = {}
+    for class_id, tally in _tallies(class_ids, today).items():
+        report[class_id] = tally.rows()
+    return report
+
+
+def class_attendance_report(class_id):
+    return attendance_report([class_id]).get(class_id, [])
+
+
+def percentage(attended, total):
+    if not total:
+        return 0.0
+    return round(100.0 * attended / total, 1)
+
+
+# Attendance figures for a single class
+class ClassTally():
+    def __init__(self, day):
+        self.names = {}
+        self.attended = {}
+        self.total = 0
+        # user_ids checked in on `day`, used to tell new sessions and
+        # repeated check-ins apart without a query
+        self.day = day
+        self.present = set()
+
+    def rows(self):
+        rows = [(self.names[user_id], percentage(attended, self.total), attended, self.total)
+                for user_id, attended in self.attended.items()]
+        rows.sort(key=lambda row: row[0])
+        return rows
+
+    def is_present(self, user_id, date):
+        return date == self.day and user_id in self.present
+
+    # Applies one new check-in, returns False if it was already counted
+    def record(self, user_id, date):
+        if date != self.day:
+            self.day = date
+            self.present = set()
+        if user_id in self.present:
+            return False
+        if not self.present:
+            # First check-in of the day opens a new session
+            self.total += 1
+        self.present.add(user_id)
+        if user_id in self.attended:
+            self.attended[user_id] += 1
+        return True
+
+
+# (class_id, date) of every session held by the classes, all of them when
+# class_ids is None. A session is a date anyone checked in on, whether they
+# are still enrolled or not; archived terms are counted the same way by
+# archive.archived_counts(). analytics.py builds its matrices on the same
+# definition.
+def session_dates(class_ids=None):
+    query = select([Attendance.class_id, Attendance.date]).distinct()
+    if class_ids is not None:
+        query = query.where(Attendance.class_id.in_(class_ids))
+    return query
+
+
+# Runs the GROUP BY query and returns {class_id: ClassTally}, archived terms included
+def _tallies(class_ids, today=None):
+    today = today or datetime.date.today()
+    # Sessions per class, counted once per class in a derived table rather
+    # than once per student row
+    dates = session_dates(class_ids).alias('session_dates')
+    sessions = select([dates.c.class_id, func.count().label('total')]) \
+        .group_by(dates.c.class_id) \
+        .alias('sessions')
+
+    rows = db.session.query(
+        Enrollment.class_id,
+        User.user_id,
+        User.name,
+        func.count(Attendance.date).label('attended'),
+        func.sum(case([(Attendance.date == today, 1)], else_=0)).label('present'),
+        func.coalesce(func.max(sessions.c.total), 0).label('total')) \
+        .join(User, User.user_id == Enrollment.user_id) \
+        .outerjoin(sessions, sessions.c.class_id == Enrollment.class_id) \
+        .outerjoin(Attendance, and_(
+            Attendance.class_id == Enrollment.class_id,
+            Attendance.user_id == Enrollment.user_id)) \
+        .filter(Enrollment.class_id.in_(class_ids), Enrollment.dropped == False) \
+        .group_by(Enrollment.class_id, User.user_id, User.name) \
+        .all()
+
+    tallies = dict((class_id, ClassTally(today)) for class_id in class_ids)
+    for row in rows:
+        tally = tallies[row.class_id]
+        tally.names[row.user_id] = row.name
+        tally.attended[row.user_id] = row.attended
+        tally.total = row.total
+        if row.present:
+            tally.present.add(row.user_id)
+
+    # Closed terms compacted into AttendanceArchive, one more query
+    for class_id, (sessions, attended) in archive.archived_counts(class_ids).items():
+        tally = tallies[class_id]
+        tally.total += sessions
+        for user_id in tally.attended:
+            tally.attended[user_id] += attended.get(user_id, 0)
+    return tallies
+
+
+# In-process per-(class, student) counters, seeded from the GROUP BY query
+# and kept current by mark_attendance. Entries expire after a TTL so check-ins
+# served by other worker processes are picked up, and the least recently used
+# class is evicted once the cache is full.
+class AttendanceCounters():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('ATTENDANCE_COUNTERS_TTL', 300)
+        app.config.setdefault('ATTENDANCE_COUNTERS_SIZE', 1024)
+
+    # Report rows for one class, from the counters when they are warm
+    def report(self, class_id):
+        tally = self._get(class_id)
+        if tally is None:
+            tally = self._seed(class_id)
+        with self._lock:
+            return tally.rows()
+
+    # True if the check-in is known to be counted already. Classes that are
+    # not warm answer False and leave the decision to the database.
+    def is_present(self, class_id, user_id, date):
+        tally = self._get(class_id)
+        if tally is None:
+            return False
+        with self._lock:
+            return tally.is_present(user_id, date)
+
+    # Applies a check-in that was just written or queued
+    def record(self, class_id, user_id, date):
+        tally = self._get(class_id)
+        if tally is None:
+            return
+        with self._lock:
+            tally.record(user_id, date)
+
+    # (date, {user_id: name}) of the students checked in today
+    def present(self, class_id):
+        tally = self._get(class_id)
+        if tally is None:
+            tally = self._seed(class_id)
+        today = datetime.date.today()
+        with self._lock:
+            if tally.day != today:
+                return today, {}
+            return today, dict((user_id, tally.names.get(user_id)) for user_id in tally.present)
+
+    def invalidate(self, class_id):
+        with self._lock:
+            self._entries.pop(class_id, None)
+
+    def _get(self, class_id):
+        with self._lock:
+            entry = self._entries.get(class_id)
+            if entry is None or entry[0] <= time.time():
+                return None
+            self._entries.move_to_end(class_id)
+            return entry[1]
+
+    def _seed(self, class_id):
+        tally = _tallies([class_id])[class_id]
+        # Check-ins still waiting in the write-behind buffer
+        for pending_class, user_id, date in ingest.pending(class_id):
+            if date == tally.day:
+                tally.record(user_id, date)
+
+        with self._lock:
+            self._entries[class_id] = (time.time() + self.app.config['ATTENDANCE_COUNTERS_TTL'], tally)
+            self._entries.move_to_end(class_id)
+            while len(self._entries) > self.app.config['ATTENDANCE_COUNTERS_SIZE']:
+                self._entries.popitem(last=False)
+        return tally
+
+
+attendance_counters = AttendanceCounters()
@@ -0,0 +1,124 @@
+from flask import current_app
+from itertools import islice
+from models import db, bump_content_version, insert_ignore, User, Enrollment
+import csv
+import secrets
+
+# Bulk roster import for teachers.
+# The CSV (columns `name` and `email`, header required) is read row by row
+# and handled in chunks of ROSTER_CHUNK_SIZE rows, one transaction each:
+# missing students are created with a single multi-row insert, everyone in
+# the chunk is then enrolled with a second one. Both inserts skip rows that
+# already exist, so importing the same roster again changes nothing. A row
+# that is not valid UTF-8 or not valid CSV ends the import: the rows before
+# it are imported and the summary reports where it stopped.
+#
+# Students created here get a password hash that matches no password.
+# Registering with the same email sends them a link to set one, see
+# claims.py.
+
+
+def import_roster(class_id, lines):
+    summary = {'rows': 0, 'created_users': 0, 'enrolled': 0, 'errors': []}
+    reader = csv.DictReader(lines)
+    try:
+        fieldnames = reader.fieldnames
+    except (csv.Error, UnicodeDecodeError) as error:
+        summary['errors'].append(_unreadable(1, error))
+        return summary
+    if not fieldnames or not {'name', 'email'} <= set(_normalize_header(fieldnames)):
+        summary['errors'].append({'row': 1, 'error': 'Header must contain name and email columns'})
+        return summary
+    reader.fieldnames = _normalize_header(fieldnames)
+
+    # Data rows start on line 2, after the header
+    rows = enumerate(reader, start=2)
+    chunk_size = current_app.config['ROSTER_CHUNK_SIZE']
+    line = 1
+    while True:
+        chunk, failed = [], None
+        try:
+            for line, row in islice(rows, chunk_size):
+                chunk.append((line, row))
+        except (csv.Error, UnicodeDecodeError) as error:
+            failed = _unreadable(line + 1, error)
+        if chunk:
+            summary['rows'] += len(chunk)
+            _import_chunk(class_id, chunk, summary)
+        if failed is not None:
+            summary['errors'].append(failed)
+            return summary
+        if len(chunk) < chunk_size:
+            return summary
+
+
+def _unreadable(line, error):
+    if isinstance(error, UnicodeDecodeError):
+        return {'row': line, 'error': 'Not valid UTF-8, import stopped here'}
+    return {'row': line, 'error': 'Not valid CSV ({0}), import stopped here'.format(error)}
+
+
+# Decodes an uploaded roster line by line, so a row that is not UTF-8 is
+# reported on its own line and the rows before it are still imported
+def decode_lines(stream):
+    encoding = 'utf-8-sig'
+    for line in stream:
+        yield line.decode(encoding)
+        encoding = 'utf-8'
+
+
+def _normalize_header(fieldnames):
+    return [(field or '').strip().lower() for field in fieldnames]
+
+
+def _import_chunk(class_id, chunk, summary):
+    students = {}
+    for line, row in chunk:
+        name = (row.get('name') or '').strip()
+        email = (row.get('email') or '').strip().lower()
+        error = _validate(name, email)
+        if error:
+            summary['errors'].append({'row': line, 'email': email, 'error': error})
+        elif email not in students:
+            students[email] = (line, name)
+    if not students:
+        return
+
+    try:
+        created = db.session.execute(insert_ignore(User.__table__), [
+            {'name': name, 'email': email, 'password_hash': '!' + secrets.token_hex(32),
+             'user_type': 'student', 'session_version': 0}
+            for email, (line, name) in students.items()])
+        summary['created_users'] += max(created.rowcount, 0)
+
+        enrollments = []
+        accounts = db.session.query(User.user_id, User.email, User.user_type) \
+            .filter(User.email.in_(list(students))) \
+            .all()
+        for account in accounts:
+            if account.user_type != 'student':
+                summary['errors'].append({'row': students[account.email][0], 'email': account.email,
+                                          'error': 'Account exists and is not a student'})
+            else:
+                enrollments.append({'class_id': class_id, 'user_id': account.user_id, 'dropped': False})
+
+        if enrollments:
+            enrolled = db.session.execute(insert_ignore(Enrollment.__table__), enrollments)
+            summary['enrolled'] += max(enrolled.rowcount, 0)
+            bump_content_version(enrollment['user_id'] for enrollment in enrollments)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _validate(name, email):
+    if not name:
+        return 'Missing name'
+    if len(name) > 50:
+        return 'Name longer than 50 characters'
+    if '@' not in email or email.startswith('@') or email.endswith('@'):
+        return 'Invalid email address'
+    if len(email) > 100:
+        return 'Email longer than 100 characters'
+    return None
@@ -0,0 +1,168 @@
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from functools import wraps
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.expression import CompoundSelect, Select
+import threading
+import time
+
+# Read/write routing between the primary database and an optional replica.
+# The replica is the 'replica' entry of SQLALCHEMY_BINDS. Views decorated
+# with @read_only send their SELECTs to it on GET requests; everything else,
+# flushes and any INSERT, UPDATE or DELETE, goes to the primary.
+#
+# A user whose request wrote to the primary (an enrollment, a check-in) is
+# kept on the primary for READ_YOUR_WRITES_SECONDS afterwards, so their
+# next page shows the change even if the replica has not caught up. The
+# replica is also skipped while it is down or lagging more than
+# REPLICA_MAX_LAG seconds; that is checked at most every
+# REPLICA_CHECK_INTERVAL seconds.
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and isinstance(clause, (Select, CompoundSelect)) and \
+                has_request_context() and g.get('read_replica'):
+            replica_router.reads_replica += 1
+            return replica_router.engine()
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# Remembers that this request wrote to the primary, through the ORM or a
+# Core statement, see ReplicaRouter._after_request
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete) and \
+            has_request_context():
+        g.wrote_primary = True
+
+
+class ReplicaRouter():
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._healthy = False
+        self._checked = 0.0
+        self.reads_replica = 0
+        self.fallbacks = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('REPLICA_MAX_LAG', 5)
+        app.config.setdefault('REPLICA_CHECK_INTERVAL', 5)
+        app.config.setdefault('REPLICA_LAG_QUERY', None)
+        app.config.setdefault('READ_YOUR_WRITES_SECONDS', 10)
+        app.after_request(self._after_request)
+
+    @property
+    def enabled(self):
+        return 'replica' in (self.app.config.get('SQLALCHEMY_BINDS') or {})
+
+    def engine(self):
+        return self.app.extensions['sqlalchemy'].db.get_engine(self.app, bind='replica')
+
+    # Called by @read_only at the start of a request
+    def use_replica(self):
+        if not self.enabled or request.method not in ('GET', 'HEAD'):
+            return False
+        if session.get('primary_until', 0) > time.time():
+            return False
+        return self.healthy()
+
+    # Pins the current user to the primary, for writes the session does not
+    # see, e.g. check-ins queued by the write-behind ingest
+    def stick_to_primary(self):
+        g.wrote_primary = True
+
+    def healthy(self):
+        now = time.time()
+        with self._lock:
+            if now < self._checked + self.app.config['REPLICA_CHECK_INTERVAL']:
+                return self._healthy
+            # Other requests keep the previous answer while this one checks
+            self._checked = now
+
+        healthy = self._check()
+        with self._lock:
+            self._healthy = healthy
+        return healthy
+
+    def mark_down(self):
+        with self._lock:
+            self._healthy = False
+            self._checked = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': int(self.enabled),
+                'healthy': int(self._healthy),
+                'reads_replica': self.reads_replica,
+                'fallbacks': self.fallbacks,
+            }
+
+    def _check(self):
+        try:
+            with self.engine().connect() as connection:
+                lag = self._lag(connection)
+        except DBAPIError:
+            self.app.logger.warning('Read replica unreachable, reading from the primary')
+            return False
+        if lag is None or lag > self.app.config['REPLICA_MAX_LAG']:
+            self.app.logger.warning('Read replica lagging (%s s), reading from the primary', lag)
+            return False
+        return True
+
+    # Seconds the replica is behind, None if replication is stopped.
+    # REPLICA_LAG_QUERY may give any query returning that number, e.g. one
+    # reading a heartbeat table.
+    def _lag(self, connection):
+        query = self.app.config['REPLICA_LAG_QUERY']
+        if query:
+            return connection.execute(query).scalar()
+        if connection.dialect.name == 'mysql':
+            status = connection.execute('SHOW SLAVE STATUS').first()
+            # A server that is not replicating is treated as caught up
+            return status['Seconds_Behind_Master'] if status is not None else 0
+        connection.execute('SELECT 1')
+        return 0
+
+    def _after_request(self, response):
+        if g.get('wrote_primary'):
+            session['primary_until'] = time.time() + self.app.config['READ_YOUR_WRITES_SECONDS']
+        return response
+
+
+replica_router = ReplicaRouter()
+
+
+# Sends the SELECTs of a GET request to the read replica when there is a
+# healthy one, including those of a response streamed after the view
+# returns. If the replica fails inside the view it is marked down and the
+# view runs again against the primary; views using this must not write on GET.
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not replica_router.use_replica():
+            return view(*args, **kwargs)
+        g.read_replica = True
+        try:
+            return view(*args, **kwargs)
+        except DBAPIError:
+            current_app.logger.exception('Read replica failed, retrying on the primary')
+            replica_router.mark_down()
+            replica_router.fallbacks += 1
+            current_app.extensions['sqlalchemy'].db.session.rollback()
+            g.read_replica = False
+            return view(*args, **kwargs)
+    return wrapper
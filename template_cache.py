@@ -0,0 +1,44 @@
+from hashlib import sha1
+from jinja2 import FileSystemBytecodeCache
+import os
+
+# Jinja bytecode cache shipped with the deployment artifact.
+# `flask compile-templates` compiles everything under templates/ into
+# JINJA_BYTECODE_CACHE_DIR before packaging, so a cold Lambda loads template
+# bytecode instead of parsing and compiling every template on first render.
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    # Keyed by template name only, the default key also hashes the absolute
+    # filename, which differs between the build machine and the Lambda
+    # runtime. Stale entries are still rejected by the source checksum.
+    def get_cache_key(self, name, filename=None):
+        return sha1(name.encode('utf-8')).hexdigest()
+
+    def dump_bytecode(self, bucket):
+        try:
+            super(TemplateBytecodeCache, self).dump_bytecode(bucket)
+        except OSError:
+            # Read-only deployment directory, keep serving from memory
+            pass
+
+
+# Must run before the first use of app.jinja_env
+def init_app(app):
+    directory = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if not directory:
+        return
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            return
+    app.jinja_options = dict(app.jinja_options, bytecode_cache=TemplateBytecodeCache(directory))
+
+
+# Compiles every template so its bytecode lands in the cache directory
+def compile_templates(app):
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names